@@ -30,6 +30,7 @@ class ControlFile(object):
         self.InstructionOutput = {}
         self.AttributeType = {}
         self.CommandLine = ''
+        self.Batch = {}
                 
     def ReadFile(self, cfile):
         #Check if file exists.  If so, read it.
@@ -106,6 +107,20 @@ class ControlFile(object):
             if line[0:5] == '*GSC7':
                 start = i
         self.CommandLine = lines[start+1].rstrip()
+
+        #Get optional batch settings, one setting per line until a blank line
+        self.Batch = {}
+        start = None
+        for i,line in enumerate(lines):
+            if line[0:5] == '*GSC8':
+                start = i
+        if start is not None:
+            for item in lines[start+1:]:
+                if not item.strip():
+                    break
+                item = item.split(',', 1)
+                if len(item) == 2:
+                    self.Batch.update({item[0].strip() : item[1].rstrip('\n')})
         
         return 0
     
@@ -138,5 +153,10 @@ class ControlFile(object):
         f.write('\n')
         f.write('*GSC7: CommandLine\n')
         f.write(self.CommandLine + '\n')
+        if self.Batch:
+            f.write('\n')
+            f.write('*GSC8: Setting,Value\n')
+            for key in sorted(self.Batch.keys()):
+                f.write(key + ',' + self.Batch[key] + '\n')
         f.close()
         
\ No newline at end of file
@@ -44,6 +44,7 @@ class ControlFileDlg(QDialog):
         bindex = self.ui.cmbBaseLayer.currentIndex()
         self.on_cmbBaseLayer_activated(bindex)
         
+        self.batch = {} #Batch settings are kept from a loaded file
         self.ui.btnBrowse.setFocus()
                     
     @pyqtSlot()
@@ -114,6 +115,7 @@ class ControlFileDlg(QDialog):
             self.ui.tblAttributeType.setItem(key,0,QTableWidgetItem(cfile.AttributeType[key][0]))
             self.ui.tblAttributeType.setItem(key,1,QTableWidgetItem(cfile.AttributeType[key][1]))
         self.ui.tbxCommandLine.setText(cfile.CommandLine)
+        self.batch = cfile.Batch
                    
     @pyqtSlot()
     def on_btnSave_clicked(self):
@@ -160,6 +162,7 @@ class ControlFileDlg(QDialog):
                 col2 = str(self.ui.tblAttributeType.item(i,1).text())
                 cfile.AttributeType.update({i : [col1,col2]})
         cfile.CommandLine = self.ui.tbxCommandLine.text()
+        cfile.Batch = self.batch
         cfile.WriteFile(f)
                 
     @pyqtSlot()
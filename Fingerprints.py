@@ -0,0 +1,82 @@
+"""
+/***************************************************************************
+Name                 : Geospatial Simulation
+Description          : Geospatial tool for managing point-based simulation models
+Date                 : 05/Dec/11
+copyright            : (C) 2011 by Dr. Kelly Thorp, USDA-ARS
+email                : kelly.thorp@ars.usda.gov
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from builtins import str
+from builtins import object
+import hashlib
+import json
+import os
+import tempfile
+
+class FingerprintFile(object):
+    """Fingerprints of the model inputs of each feature as of its last
+    successful simulation, kept in a JSON file {fid : fingerprint}"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def Read(self):
+        "Return {fid : fingerprint}, empty if the file is missing or unreadable"
+        try:
+            f = open(self.path, 'r')
+            data = json.load(f)
+            f.close()
+        except (IOError, OSError, ValueError):
+            return {}
+        fingerprints = {}
+        for fid in data:
+            fingerprints.update({int(fid):data[fid]})
+        return fingerprints
+
+    def Write(self, fingerprints):
+        "Replace the file with fingerprints"
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        f = os.fdopen(fd, 'w')
+        json.dump(dict([(str(fid), fingerprints[fid]) for fid in fingerprints]), f)
+        f.close()
+        os.replace(tmp, self.path)
+
+def Salt(cfile, templates, instructions, formats):
+    """Hash of everything besides the attribute values that decides a
+    feature's results: the command line, templates, instructions, batch
+    settings and the formats of the attribute codes"""
+    h = hashlib.sha256()
+    parts = [cfile.CommandLine, repr(sorted(cfile.Batch.items()))]
+    for key in sorted(templates.keys()):
+        parts.append(cfile.TemplateInput[key][1])
+        parts.append(templates[key].text)
+    for key in sorted(instructions.keys()):
+        parts.append(cfile.InstructionOutput[key][1])
+        parts.append(repr(instructions[key].program))
+    for key in sorted(formats.keys()):
+        parts.append(repr((formats[key].ftype, formats[key].width)))
+    for part in parts:
+        data = part.encode('utf-8', 'surrogateescape')
+        h.update(str(len(data)).encode('ascii') + b':')
+        h.update(data)
+    return h.hexdigest()
+
+def Fingerprint(salt, values):
+    "Fingerprint of one feature from Salt and its {AttributeCode key : value}"
+    h = hashlib.sha256(salt.encode('ascii'))
+    for key in sorted(values.keys()):
+        data = repr(values[key]).encode('utf-8', 'surrogateescape')
+        h.update(str(len(data)).encode('ascii') + b':')
+        h.update(data)
+    return h.hexdigest()
@@ -23,6 +23,7 @@ from qgis.PyQt.QtCore import Qt, pyqtSlot
 from qgis.PyQt.QtWidgets import QDialog, QMessageBox, QListWidgetItem, QApplication
 from qgis.core import QgsMapLayer, QgsProject, QgsField, QgsSpatialIndex, QgsFeatureRequest, QgsWkbTypes
 from .Ui_GeoprocessorDlg import Ui_GeoprocessorDlg
+from . import ProgressReporter
 
 # create the dialog for GeoprocessorDlg
 class GeoprocessorDlg(QDialog):
@@ -154,6 +155,9 @@ class GeoprocessorDlg(QDialog):
         len2 = len(bfields)
         b1 = 0
         b2 = bprovider.featureCount()
+        progress = ProgressReporter.ProgressReporter(
+            ProgressReporter.BarShow(self.ui.ProgressBar, QApplication.processEvents))
+        progress.Start(b2)
         attr={}
         for bfeat in bprovider.getFeatures():
             b1+=1
@@ -240,8 +244,7 @@ class GeoprocessorDlg(QDialog):
             if not result:
                 QMessageBox.critical(self, 'Vector Geoprocessor', 'Could not change attribute value.')
                 return           
-            self.ui.ProgressBar.setValue(float(b1)/float(b2) * 100.0)
-            QApplication.processEvents()
+            progress.Update(b1)
 
         self.setCursor(Qt.ArrowCursor)
             
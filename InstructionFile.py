@@ -0,0 +1,112 @@
+"""
+/***************************************************************************
+Name                 : Geospatial Simulation
+Description          : Geospatial tool for managing point-based simulation models
+Date                 : 05/Dec/11
+copyright            : (C) 2011 by Dr. Kelly Thorp, USDA-ARS
+email                : kelly.thorp@ars.usda.gov
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from builtins import object
+import os
+from . import OutputFile
+
+#Instruction commands
+PLUS = 0
+FIND = 1
+GET = 2
+
+class InstructionFile(object):
+    """Read a Geospatial Simulation Instruction (GSI) file and compile it into
+    a program that extracts output attributes from a model output file.
+
+    Each instruction line becomes (attribute, [(command, argument), ...]):
+    PLUS takes a row count, FIND a search string and GET a (start, end)
+    column extent."""
+
+    def __init__(self):
+        self.program = []
+
+    def ReadFile(self, ifile):
+        #Check if file exists.  If so, read it.
+        if (os.path.exists(ifile)) == False:
+            return 1
+        else:
+            f = open(ifile, 'r')
+            lines = f.readlines()
+            f.close()
+
+        #Check file type
+        if not lines or lines[0][0:44] != 'Geospatial Simulation Instruction (GSI) File':
+            return 2
+
+        #Compile instruction lines.  Note the last item keeps its newline.
+        self.program = []
+        for line in lines[1:]:
+            line = line.split(',')
+            if len(line) < 2:
+                continue
+            ops = []
+            for item in line[1:]:
+                try:
+                    if item[0:4] in ['Plus', 'plus', 'PLUS']:
+                        ops.append((PLUS, int(item[4:])))
+                    elif item[0:4] in ['Find', 'find', 'FIND']:
+                        ops.append((FIND, item[4:]))
+                    elif item[0:3] in ['Get', 'get', 'GET']:
+                        extents = item[3:].split(':')
+                        ops.append((GET, (int(extents[0]), int(extents[1]))))
+                    else:
+                        return 3
+                except (ValueError, IndexError):
+                    return 3
+            self.program.append((line[0], ops))
+
+        return 0
+
+    def Attributes(self):
+        "Return the output attribute names set by the program"
+        return [attribute for attribute, ops in self.program]
+
+    def Tokens(self):
+        "Return the search strings of all FIND commands"
+        tokens = []
+        for attribute, ops in self.program:
+            for cmd, arg in ops:
+                if cmd == FIND and arg not in tokens:
+                    tokens.append(arg)
+        return tokens
+
+    def Execute(self, output):
+        """Run the program against an OutputFile or OutputLines, return
+        [(attribute, value)]"""
+        values = []
+        output.Index(self.Tokens())
+        for attribute, ops in self.program:
+            try:
+                values.extend(self.ExecuteLine(attribute, ops, output))
+            except OutputFile.TextFallback:
+                values.extend(self.ExecuteLine(attribute, ops, output.Text()))
+        return values
+
+    def ExecuteLine(self, attribute, ops, output):
+        "Run one instruction line"
+        values = []
+        pos = output.Start()
+        for cmd, arg in ops:
+            if cmd == PLUS:
+                pos = output.Plus(pos, arg)
+            elif cmd == FIND:
+                pos = output.Find(pos, arg)
+            else:
+                values.append((attribute, output.Get(pos, arg[0], arg[1])))
+        return values
@@ -0,0 +1,104 @@
+"""
+/***************************************************************************
+Name                 : Geospatial Simulation
+Description          : Geospatial tool for managing point-based simulation models
+Date                 : 05/Dec/11
+copyright            : (C) 2011 by Dr. Kelly Thorp, USDA-ARS
+email                : kelly.thorp@ars.usda.gov
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Named pipe model inputs and outputs.  This module does not import Qt or QGIS.
+"""
+from builtins import object
+import os
+import stat
+import threading
+
+class ModelFifo(object):
+    """Pass the rendered inputs of one model run to the model and its outputs
+    back through named pipes (FIFOs) instead of files.  The model must open
+    each input and output once and read or write it from start to end.
+    POSIX only.
+
+    Inputs:
+    inputs  -- {input path : rendered text}
+    outputs -- List of output paths"""
+
+    def __init__(self, inputs, outputs):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.data = {}
+        self.threads = []
+        self.opened = set() #Pipes whose open() has returned on this side
+        self.unopened = set() #Pipes the model never opened
+
+    def Start(self):
+        "Make the pipes and start a thread for each, before the model starts"
+        for path in list(self.inputs.keys()) + self.outputs:
+            MakeFifo(path)
+        for path in self.inputs:
+            self.threads.append((path, os.O_RDONLY, threading.Thread(target=self.Write,
+                                                                     args=(path,))))
+        for path in self.outputs:
+            self.threads.append((path, os.O_WRONLY, threading.Thread(target=self.Read,
+                                                                     args=(path,))))
+        for path, flag, thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def Write(self, path):
+        try:
+            f = open(path, 'w')
+            self.opened.add(path)
+            try:
+                f.write(self.inputs[path])
+            finally:
+                f.close()
+        except (IOError, OSError): #The model stopped reading
+            pass
+
+    def Read(self, path):
+        f = open(path, 'rb')
+        self.opened.add(path)
+        self.data.update({path:f.read()})
+        f.close()
+
+    def Finish(self):
+        """Call after the model exits.  Returns {output path : bytes written}.
+        Pipes the model never opened are opened from this side so their
+        threads finish; those outputs are left out."""
+        for path, flag, thread in self.threads:
+            for i in range(100):
+                if not thread.is_alive() or path in self.opened:
+                    break
+                try:
+                    os.close(os.open(path, flag | os.O_NONBLOCK))
+                    self.unopened.add(path)
+                except OSError: #Thread not yet waiting on the pipe, or pipe removed
+                    pass
+                thread.join(0.01)
+            if thread.is_alive() and path not in self.opened:
+                #The model removed the pipe, so its thread can never open it
+                self.unopened.add(path)
+                continue
+            thread.join()
+        #The thread may have opened a pipe the model wrote just before it was
+        #opened from this side too; its output is then complete
+        return dict([(path, self.data[path]) for path in self.data
+                     if path not in self.unopened or self.data[path]])
+
+def MakeFifo(path):
+    "Make a named pipe at path, replacing any regular file there"
+    if os.path.exists(path):
+        if stat.S_ISFIFO(os.stat(path).st_mode):
+            return
+        os.remove(path)
+    os.mkfifo(path)
@@ -0,0 +1,259 @@
+"""
+/***************************************************************************
+Name                 : Geospatial Simulation
+Description          : Geospatial tool for managing point-based simulation models
+Date                 : 05/Dec/11
+copyright            : (C) 2011 by Dr. Kelly Thorp, USDA-ARS
+email                : kelly.thorp@ars.usda.gov
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Model process launching.  This module does not import Qt or QGIS.
+"""
+from builtins import object
+import asyncio
+import codecs
+import os
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+#If set, a directory where an empty file named by the process ID of each
+#running model, the leader of its own process group, is kept, so that the parent of a pool worker can kill the
+#models of a worker it terminated
+piddir = None
+
+#Characters and commands that need a shell to run a command line
+if sys.platform == 'win32':
+    SHELLCHARS = '&|<>^%!()\n'
+    BUILTINS = ['assoc', 'call', 'cd', 'chdir', 'cls', 'copy', 'date', 'del', 'dir', 'echo',
+                'erase', 'md', 'mkdir', 'mklink', 'move', 'path', 'pushd', 'popd', 'rd',
+                'ren', 'rename', 'rmdir', 'set', 'start', 'time', 'type', 'ver', 'vol']
+else:
+    SHELLCHARS = '|&;<>()$`*?[]{}~#\n'
+    BUILTINS = ['.', 'alias', 'cd', 'eval', 'exec', 'export', 'set', 'source', 'ulimit',
+                'umask', 'unset']
+
+class ModelCommand(object):
+    """A model command line parsed once into an argument list, with the
+    executable looked up on PATH once, so each run starts the model directly
+    instead of through the shell.  Command lines using shell syntax or shell
+    builtins, or whose executable is not found, are still run by the shell,
+    which reports a missing model with exit status 127 or 126.
+
+    Inputs:
+    command  -- Command line
+    modeldir -- Model directory, where an executable given with a relative
+                path is checked"""
+
+    def __init__(self, command, modeldir=''):
+        self.command = command
+        self.args = command
+        self.shell = True
+        if any([c in command for c in SHELLCHARS]):
+            return
+        try:
+            args = shlex.split(command, posix=sys.platform != 'win32')
+        except ValueError:
+            return
+        if sys.platform == 'win32':
+            #Non-POSIX splitting keeps the quotes around quoted arguments
+            for i, arg in enumerate(args):
+                if len(arg) > 1 and arg[0] == arg[-1] == '"':
+                    arg = arg[1:-1]
+                if '"' in arg:
+                    return
+                args[i] = arg
+        if not args or args[0].lower() in BUILTINS or '=' in args[0]:
+            return
+        if os.path.dirname(args[0]) == '':
+            executable = shutil.which(args[0])
+            if executable is None:
+                return
+            args[0] = executable
+        elif not os.access(os.path.join(modeldir, args[0]), os.X_OK):
+            return
+        self.args = args
+        self.shell = False
+
+    def __str__(self):
+        return self.command
+
+def GroupOptions():
+    "Popen keyword arguments that start the model in its own process group"
+    if sys.platform == 'win32':
+        return {'creationflags':subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {'start_new_session':True}
+
+def KillGroup(pid):
+    "Kill a model process and everything it started"
+    try:
+        if sys.platform == 'win32':
+            subprocess.run(['taskkill', '/F', '/T', '/PID', str(pid)],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+def Started(pid):
+    "Record a running model"
+    if piddir is not None:
+        open(os.path.join(piddir, str(pid)), 'w').close()
+
+def Ended(pid):
+    "Forget a model that has exited or was killed"
+    if piddir is not None:
+        try:
+            os.remove(os.path.join(piddir, str(pid)))
+        except OSError:
+            pass
+
+def KillRecorded(directory):
+    "Kill the models recorded in directory by pool workers, see piddir"
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.isdigit():
+            KillGroup(int(name))
+
+def Run(command, stdout, stderr, cwd, timeout=None, timer=None, tid=None):
+    """Run a ModelCommand in its own process group.  Returns a
+    subprocess.CompletedProcess.  If the model runs longer than timeout
+    seconds, the whole group is killed and subprocess.TimeoutExpired is
+    raised.  Starting the process is timed as the spawn stage of timer."""
+    t0 = time.perf_counter()
+    try:
+        p = subprocess.Popen(command.args, stdout=stdout, stderr=stderr, shell=command.shell,
+                             text=True, cwd=cwd, **GroupOptions())
+    except OSError as e:
+        return LaunchError(command, e, stdout, stderr)
+    if timer is not None:
+        timer.Stop('spawn', t0, tid)
+    Started(p.pid)
+    try:
+        try:
+            out, err = p.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            KillGroup(p.pid)
+            out, err = p.communicate()
+            raise subprocess.TimeoutExpired(command.command, timeout, out, err)
+        except BaseException:
+            KillGroup(p.pid)
+            p.wait()
+            raise
+    finally:
+        Ended(p.pid)
+    return subprocess.CompletedProcess(command.command, p.returncode, out, err)
+
+def LaunchError(command, e, stdout, stderr):
+    """CompletedProcess of a model that could not be started (OSError e), with
+    the exit status a shell gives: 127 if not found, otherwise 126"""
+    returncode = 127 if isinstance(e, FileNotFoundError) else 126
+    message = 'Could not start %s: %s\n' % (command.args[0], e.strerror or e)
+    out = None
+    err = None
+    if stdout == subprocess.PIPE:
+        out = ''
+    if stderr == subprocess.PIPE:
+        err = message
+    elif stdout not in [subprocess.PIPE, subprocess.DEVNULL]:
+        stdout.write(message.encode('utf-8'))
+    return subprocess.CompletedProcess(command.command, returncode, out, err)
+
+class AsyncLauncher(object):
+    """Run model command lines as asyncio subprocesses, at most concurrency
+    at a time.  stdout and stderr are read incrementally as the model writes
+    them and passed to stream(tag, name, text) if given.
+
+    Inputs:
+    command     -- ModelCommand
+    concurrency -- Maximum number of model processes running at once
+    stream      -- Optional callback for each chunk of model output
+    timer       -- Optional StageTimer for the spawn stage"""
+
+    def __init__(self, command, concurrency, stream=None, timer=None):
+        self.command = command
+        self.concurrency = concurrency
+        self.stream = stream
+        self.timer = timer
+        self.semaphore = None
+
+    async def Launch(self, cwd, tag=None, output=None, timeout=None):
+        """Run the model in cwd.  Returns a subprocess.CompletedProcess.  If
+        output is given, stdout and stderr go straight to it instead.  A model
+        running longer than timeout seconds is killed with its process group
+        and subprocess.TimeoutExpired is raised."""
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.semaphore:
+            t0 = time.perf_counter()
+            try:
+                if output is not None:
+                    proc = await self.Create(output, subprocess.STDOUT, cwd)
+                else:
+                    proc = await self.Create(subprocess.PIPE, subprocess.PIPE, cwd)
+            except OSError as e:
+                if output is not None:
+                    return LaunchError(self.command, e, output, subprocess.STDOUT)
+                return LaunchError(self.command, e, subprocess.PIPE, subprocess.PIPE)
+            if self.timer is not None:
+                self.timer.Stop('spawn', t0)
+            Started(proc.pid)
+            try:
+                stdout, stderr, returncode = await asyncio.wait_for(self.Communicate(proc, tag),
+                                                                    timeout)
+            except asyncio.TimeoutError:
+                KillGroup(proc.pid)
+                await proc.wait()
+                raise subprocess.TimeoutExpired(self.command.command, timeout)
+            except BaseException:
+                KillGroup(proc.pid)
+                raise
+            finally:
+                Ended(proc.pid)
+        return subprocess.CompletedProcess(self.command.command, returncode, stdout, stderr)
+
+    async def Create(self, stdout, stderr, cwd):
+        "Start the model process"
+        if self.command.shell:
+            return await asyncio.create_subprocess_shell(self.command.args, stdout=stdout,
+                                                         stderr=stderr, cwd=cwd,
+                                                         **GroupOptions())
+        return await asyncio.create_subprocess_exec(*self.command.args, stdout=stdout,
+                                                    stderr=stderr, cwd=cwd, **GroupOptions())
+
+    async def Communicate(self, proc, tag):
+        "Wait for the model, returning (stdout, stderr, returncode)"
+        stdout = None
+        stderr = None
+        if proc.stdout is not None:
+            stdout, stderr = await asyncio.gather(self.Read(proc.stdout, tag, 'stdout'),
+                                                  self.Read(proc.stderr, tag, 'stderr'))
+        returncode = await proc.wait()
+        return stdout, stderr, returncode
+
+    async def Read(self, reader, tag, name):
+        "Collect a process output stream, passing each chunk of text to stream"
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        chunks = []
+        while True:
+            data = await reader.read(65536)
+            text = decoder.decode(data, not data)
+            if text:
+                chunks.append(text)
+                if self.stream is not None:
+                    self.stream(tag, name, text)
+            if not data:
+                break
+        return ''.join(chunks).replace('\r\n', '\n')
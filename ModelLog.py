@@ -0,0 +1,113 @@
+"""
+/***************************************************************************
+Name                 : Geospatial Simulation
+Description          : Geospatial tool for managing point-based simulation models
+Date                 : 05/Dec/11
+copyright            : (C) 2011 by Dr. Kelly Thorp, USDA-ARS
+email                : kelly.thorp@ars.usda.gov
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from builtins import str
+from builtins import range
+from builtins import object
+import os
+import subprocess
+
+#Characters of model output kept in the summary sent to the user interface
+TAIL = 1000
+
+class ModelLog(object):
+    """Send model stdout and stderr straight to log files.  The model process
+    writes to the file descriptor itself, so output never passes through
+    Python or the user interface.
+
+    Inputs:
+    directory -- Log directory, created if missing
+    name      -- Base name of the rotating log file
+    verbosity -- 0 discards model output
+                 1 appends it to name.log, rotated at maxbytes
+                 2 writes one log file per feature, fid.log
+    maxbytes  -- Size at which name.log is rotated
+    backups   -- Number of rotated logs kept (name.log.1 ... name.log.N)"""
+
+    def __init__(self, directory, name='model', verbosity=1,
+                 maxbytes=10*1024*1024, backups=5):
+        self.directory = directory
+        self.name = name
+        self.verbosity = verbosity
+        self.maxbytes = maxbytes
+        self.backups = backups
+        self.path = None
+        self.start = 0
+
+    def Copy(self, suffix):
+        "Return a ModelLog with its own rotating log file, for one worker"
+        return ModelLog(self.directory, self.name + '-' + str(suffix), self.verbosity,
+                        self.maxbytes, self.backups)
+
+    def Open(self, fid):
+        "Return the stdout target for a model run of feature fid"
+        if self.verbosity <= 0:
+            self.path = None
+            return subprocess.DEVNULL
+        os.makedirs(self.directory, exist_ok=True)
+        if self.verbosity == 1:
+            self.path = os.path.join(self.directory, self.name + '.log')
+            if os.path.exists(self.path) and os.path.getsize(self.path) >= self.maxbytes:
+                self.Rotate()
+            f = open(self.path, 'ab')
+        else:
+            self.path = os.path.join(self.directory, '%s.log' % fid)
+            f = open(self.path, 'wb')
+        f.write(('*** Feature %s\n' % fid).encode('utf-8'))
+        f.flush()
+        self.start = f.tell()
+        return f
+
+    def Close(self, f, fid, returncode):
+        "Close the target from Open and return a bounded summary of the run"
+        summary = 'Feature %s: %s' % (fid, Status(returncode))
+        if f == subprocess.DEVNULL:
+            return summary
+        f.close()
+        size = os.path.getsize(self.path)
+        f = open(self.path, 'rb')
+        f.seek(max(self.start, size - TAIL))
+        tail = f.read().decode('utf-8', 'replace')
+        f.close()
+        if tail:
+            summary += '\n' + tail.rstrip('\n')
+        return summary
+
+    def Rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            src = '%s.%d' % (self.path, i)
+            if os.path.exists(src):
+                os.replace(src, '%s.%d' % (self.path, i + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+def Summary(fid, returncode, stdout, stderr):
+    "Bounded summary of a model run whose output was captured in memory"
+    summary = 'Feature %s: %s' % (fid, Status(returncode))
+    tail = ((stdout or '') + (stderr or ''))[-TAIL:]
+    if tail:
+        summary += '\n' + tail.rstrip('\n')
+    return summary
+
+def Status(returncode):
+    "Describe how a model run ended.  returncode is None if it timed out."
+    if returncode is None:
+        return 'timed out'
+    return 'exit status %s' % returncode
@@ -0,0 +1,275 @@
+"""
+/***************************************************************************
+Name                 : Geospatial Simulation
+Description          : Geospatial tool for managing point-based simulation models
+Date                 : 05/Dec/11
+copyright            : (C) 2011 by Dr. Kelly Thorp, USDA-ARS
+email                : kelly.thorp@ars.usda.gov
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from builtins import range
+from builtins import object
+import bisect
+import codecs
+import io
+import locale
+import mmap
+import os
+import re
+
+#Tokens matching more lines than this leave the shared scan of Index
+FREQUENT = 1000
+
+class TextFallback(Exception):
+    "Raised when an instruction cannot be run exactly on the raw bytes"
+    pass
+
+class OutputLines(object):
+    """Model output file read as a list of text lines, the way instruction
+    files have always been run.  Positions are row numbers."""
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def Text(self):
+        return self
+
+    def Start(self):
+        return 0
+
+    def Plus(self, rownum, n):
+        return rownum + n
+
+    def Find(self, rownum, token):
+        for i in range(rownum, len(self.lines)):
+            if token in self.lines[i]:
+                return i
+        return rownum
+
+    def Get(self, rownum, start, end):
+        return self.lines[rownum][start:end]
+
+    def Index(self, tokens):
+        pass
+
+    def Close(self):
+        pass
+
+class OutputFile(object):
+    """Model output file scanned through mmap.  Find searches the raw bytes,
+    in one scan shared by all tokens passed to Index, and only the lines read
+    by Get are decoded, so large outputs are never read into Python strings
+    as a whole.
+
+    Positions are (offset, over): the byte offset of the start of the current
+    line, and the number of rows past the end of the file.  Results match
+    OutputLines exactly.  Files with carriage returns, encodings that are not
+    byte-searchable and rows before the start of the file raise TextFallback,
+    and the caller reruns that instruction with Text().
+
+    If data is given, it is the content of the file, already read."""
+
+    def __init__(self, ofile, encoding=None, data=None):
+        self.path = ofile
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self.f = None
+        if data is not None:
+            self.data = data
+        else:
+            self.f = open(ofile, 'rb')
+            if os.fstat(self.f.fileno()).st_size > 0:
+                self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = b''
+        self.size = len(self.data)
+        self.tokens = {}
+        self.found = {} #{token : (offset searched from, match offset or -1)}
+        self.index = {} #{token : TokenScan}
+        self.lines = None
+        #Text mode reads a lone carriage return as a line break
+        self.bytesafe = ByteSafe(self.encoding) and self.data.find(b'\r') < 0
+
+    def Text(self):
+        "Return the file as OutputLines"
+        if self.lines is None:
+            f = io.TextIOWrapper(io.BytesIO(self.data[:]), encoding=self.encoding,
+                                 errors='replace')
+            self.lines = OutputLines(f.readlines())
+            f.close()
+        return self.lines
+
+    def Start(self):
+        if not self.bytesafe:
+            raise TextFallback()
+        return (0, 0)
+
+    def Plus(self, pos, n):
+        offset, over = pos
+        for i in range(abs(n)):
+            if n > 0:
+                if offset < self.size:
+                    q = self.data.find(b'\n', offset)
+                    offset = q + 1 if q >= 0 else self.size
+                else:
+                    over += 1
+            elif over > 0:
+                over -= 1
+            elif offset == 0:
+                raise TextFallback() #Negative rows index from the end of the list
+            else:
+                offset = self.data.rfind(b'\n', 0, offset - 1) + 1
+        return (offset, over)
+
+    def Find(self, pos, token):
+        offset, over = pos
+        if offset >= self.size:
+            return pos
+        scan = self.index.get(token)
+        if scan is not None:
+            start = scan.Line(token, offset)
+            if token in scan.lines:
+                return (start, 0) if start is not None else pos
+        btoken = self.tokens.get(token)
+        if btoken is None:
+            if '\ufffd' in token:
+                raise TextFallback() #Would also match undecodable bytes
+            try:
+                btoken = token.encode(self.encoding)
+            except UnicodeError:
+                raise TextFallback()
+            self.tokens.update({token:btoken})
+        #Finds move forward through the file, so the last match of a token is
+        #reused while it is still ahead, and a miss stays a miss
+        last = self.found.get(token)
+        if last is not None and last[0] <= offset and (last[1] < 0 or offset <= last[1]):
+            p = last[1]
+        else:
+            p = self.data.find(btoken, offset)
+            self.found.update({token:(offset, p)})
+        if p < 0:
+            return pos
+        return (self.data.rfind(b'\n', offset, p) + 1 or offset, 0)
+
+    def Get(self, pos, start, end):
+        offset, over = pos
+        if offset >= self.size:
+            raise IndexError('list index out of range')
+        q = self.data.find(b'\n', offset)
+        line = self.data[offset:q + 1 if q >= 0 else self.size]
+        return line.decode(self.encoding, 'replace')[start:end]
+
+    def Index(self, tokens):
+        """Find the lines containing tokens in one scan of the file, shared by
+        all of them, instead of one scan per token.  Tokens that can overlap
+        each other get separate scans so none of their matches are hidden."""
+        if not self.bytesafe:
+            return
+        groups = []
+        for token in tokens:
+            if token == '' or '\ufffd' in token or token in self.index:
+                continue
+            try:
+                btoken = token.encode(self.encoding)
+            except UnicodeError:
+                continue
+            for group in groups:
+                if not [b for b in group if Overlap(b, btoken)]:
+                    break
+            else:
+                group = {}
+                groups.append(group)
+            group.update({btoken:token})
+        for group in groups:
+            scan = TokenScan(self.data, group)
+            for btoken in group:
+                self.index.update({group[btoken]:scan})
+
+    def Close(self):
+        #Unfinished scans hold the mmap's buffer, which would stop it closing
+        for scan in self.index.values():
+            scan.matches = None
+        self.index = {}
+        if self.f is not None:
+            if self.size > 0:
+                self.data.close()
+            self.f.close()
+
+class TokenScan(object):
+    """One forward scan of data for any of a group of tokens that cannot
+    overlap each other, run only as far as Find needs"""
+
+    def __init__(self, data, group):
+        self.data = data
+        self.group = group
+        self.lines = dict([(group[btoken], []) for btoken in group]) #{token : [line start]}
+        self.matches = re.finditer(b'|'.join([re.escape(b) for b in group]), data)
+        self.start = 0
+        self.end = -1
+
+    def Line(self, token, offset):
+        """Start of the first line at or after offset containing token, None if
+        none or if token was dropped from the scan"""
+        lines = self.lines.get(token)
+        while lines is not None and (not lines or lines[-1] < offset) and self.matches is not None:
+            self.Next()
+            lines = self.lines.get(token)
+        if lines is None:
+            return None
+        i = bisect.bisect_left(lines, offset)
+        return lines[i] if i < len(lines) else None
+
+    def Next(self):
+        "Record the line of the next match"
+        m = next(self.matches, None)
+        if m is None:
+            self.matches = None
+            return
+        p = m.start()
+        if p > self.end:
+            self.start = self.data.rfind(b'\n', max(self.end, 0), p) + 1
+            self.end = self.data.find(b'\n', p)
+            if self.end < 0:
+                self.end = len(self.data)
+        token = self.group[m.group()]
+        lines = self.lines[token]
+        if not lines or lines[-1] != self.start:
+            lines.append(self.start)
+            if len(lines) > FREQUENT:
+                self.Drop(m.group(), p)
+
+    def Drop(self, btoken, p):
+        """Leave a frequent token to the plain find, whose next match is never
+        far, and go on scanning for the others from its match at p"""
+        del self.lines[self.group[btoken]]
+        del self.group[btoken]
+        if self.group:
+            #No other token starts before p, or at p as none overlap it
+            pattern = re.compile(b'|'.join([re.escape(b) for b in self.group]))
+            self.matches = pattern.finditer(self.data, p)
+        else:
+            self.matches = None
+
+def Overlap(a, b):
+    "True if a match of a could hide a match of b in the same scan, or the reverse"
+    if a in b or b in a:
+        return True
+    for k in range(1, min(len(a), len(b))):
+        if a.endswith(b[:k]) or b.endswith(a[:k]):
+            return True
+    return False
+
+def ByteSafe(encoding):
+    """True if text in encoding can be searched as bytes: ASCII-compatible,
+    with no character's bytes occurring inside another character's"""
+    name = codecs.lookup(encoding).name
+    return (name in ['utf-8', 'ascii', 'latin-1', 'iso8859-1'] or
+            name.startswith('cp125') or name.startswith('iso8859'))
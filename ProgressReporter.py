@@ -0,0 +1,122 @@
+"""
+/***************************************************************************
+Name                 : Geospatial Simulation
+Description          : Geospatial tool for managing point-based simulation models
+Date                 : 05/Dec/11
+copyright            : (C) 2011 by Dr. Kelly Thorp, USDA-ARS
+email                : kelly.thorp@ars.usda.gov
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Throttled progress reporting.  This module does not import Qt or QGIS.
+"""
+from builtins import object
+import time
+
+class ProgressReporter(object):
+    """Pass progress of a long loop on to a progress bar or text line at most
+    once per interval, with the rate, the time left and the share of time
+    spent in each stage.
+
+    Call Start() before the loop, Update(done, total) as often as convenient
+    and Finish() after it.
+
+    Inputs:
+    show     -- show(reporter, done, total), called when an update is due.
+                Text(), Short(), Rate(), ETA() and Stages() describe the progress.
+    unit     -- Name of the items counted, e.g. 'features'
+    interval -- Minimum seconds between calls of show
+    timer    -- Optional StageTimer for Stages()"""
+
+    def __init__(self, show, unit='features', interval=0.25, timer=None):
+        self.show = show
+        self.unit = unit
+        self.interval = interval
+        self.timer = timer
+        self.Start()
+
+    def Start(self, total=0):
+        self.t0 = time.perf_counter()
+        self.last = None
+        self.done = 0
+        self.total = total
+
+    def Update(self, done, total=None):
+        "Record progress, calling show if interval has passed or the loop is done"
+        self.done = done
+        if total is not None:
+            self.total = total
+        now = time.perf_counter()
+        if self.last is None or now - self.last >= self.interval or done >= self.total:
+            self.last = now
+            self.show(self, self.done, self.total)
+
+    def Finish(self):
+        "Show the final state, whenever the last update was shown"
+        self.last = time.perf_counter()
+        self.show(self, self.done, self.total)
+
+    def Rate(self):
+        "Items per second since Start"
+        elapsed = time.perf_counter() - self.t0
+        if elapsed <= 0.0:
+            return 0.0
+        return self.done / elapsed
+
+    def ETA(self):
+        "Estimated seconds left, None before the first item is done"
+        rate = self.Rate()
+        if rate <= 0.0:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    def Stages(self):
+        "Share of the time in each stage of the timer, e.g. 'model 82%, render 9%'"
+        if self.timer is None:
+            return ''
+        totals = self.timer.Totals()
+        alltime = sum(totals.values())
+        if alltime <= 0.0:
+            return ''
+        stages = sorted(totals.keys(), key=lambda stage: -totals[stage])
+        return ', '.join(['%s %d%%' % (stage, round(100.0 * totals[stage] / alltime))
+                          for stage in stages])
+
+    def Short(self):
+        "Rate and time left, e.g. '35.2 features/s, ETA 0:00:11'"
+        text = '%.1f %s/s' % (self.Rate(), self.unit)
+        eta = self.ETA()
+        if eta is not None and self.done < self.total:
+            text += ', ETA %s' % Duration(eta)
+        return text
+
+    def Text(self):
+        "One line of progress, e.g. '120 of 500 features, 35.2 features/s, ETA 0:00:11'"
+        text = '%d of %d %s, %s' % (self.done, self.total, self.unit, self.Short())
+        stages = self.Stages()
+        if stages:
+            text += ' (%s)' % stages
+        return text
+
+def Duration(seconds):
+    "Format seconds as H:MM:SS"
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def BarShow(bar, refresh):
+    """show callback for a QProgressBar: set its value and text, with the
+    stage shares as tooltip, then call refresh (e.g. QApplication.processEvents)"""
+    def show(reporter, done, total):
+        if total > 0:
+            bar.setValue(int(100.0 * done / total))
+        bar.setFormat('%p%  ' + reporter.Short())
+        bar.setToolTip(reporter.Stages())
+        refresh()
+    return show
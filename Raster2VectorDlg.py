@@ -25,6 +25,7 @@ from qgis.core import QgsMapLayer, QgsProject, QgsFeature, QgsVectorLayer
 from qgis.core import QgsField, QgsPoint, QgsRectangle, QgsGeometry, QgsVectorFileWriter
 from .Ui_Raster2VectorDlg import Ui_Raster2VectorDlg
 import os
+from . import ProgressReporter
 # create the dialog for Raster2VectorDlg
 class Raster2VectorDlg(QDialog):
     def __init__(self, iface): 
@@ -130,7 +131,11 @@ class Raster2VectorDlg(QDialog):
         pvlayer.startEditing()
         count = 0
         attr = []
-        totpix = float(numX*numY)
+        totpix = numX*numY
+        progress = ProgressReporter.ProgressReporter(
+            ProgressReporter.BarShow(self.ui.ProgressBar, QApplication.processEvents),
+            unit='pixels')
+        progress.Start(totpix)
         for y in range(numY):
             for x in range(numX):       
                 newpt = QgsPoint(LLX+x*pixsizeX+pixsizeX/2.0,
@@ -157,8 +162,7 @@ class Raster2VectorDlg(QDialog):
                 if self.ui.rbPolygons.isChecked():
                     del newrect
                 count+=1
-                self.ui.ProgressBar.setValue(float(count)/totpix * 100.0)
-                QApplication.processEvents()  
+                progress.Update(count)
         pvlayer.commitChanges()
         pvlayer.updateExtents()
         
@@ -0,0 +1,133 @@
+"""
+/***************************************************************************
+Name                 : Geospatial Simulation
+Description          : Geospatial tool for managing point-based simulation models
+Date                 : 05/Dec/11
+copyright            : (C) 2011 by Dr. Kelly Thorp, USDA-ARS
+email                : kelly.thorp@ars.usda.gov
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Long-lived model processes.  This module does not import Qt or QGIS.
+"""
+from builtins import object
+import queue
+import subprocess
+import threading
+import time
+from . import ModelLauncher
+
+class ResidentModel(object):
+    """A model process that stays running and simulates one feature per
+    request, so the model's startup cost is paid once per worker.
+
+    Protocol, one line each way per feature:
+    GeoSim -> model  RUN <directory>   Inputs are written in directory; the
+                                       model writes its outputs there.
+    model -> GeoSim  DONE [status]     Run finished, status defaults to 0.
+    Any other line the model prints is kept as model output.  The model
+    should exit when its stdin is closed.
+
+    Inputs:
+    command -- Command line starting the model, run through the shell
+    cwd     -- Working directory of the model process"""
+
+    def __init__(self, command, cwd):
+        self.command = command
+        self.cwd = cwd
+        self.proc = None
+        self.lines = None
+
+    def Start(self):
+        self.proc = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     shell=True, cwd=self.cwd, bufsize=1, text=True,
+                                     encoding='utf-8', errors='replace',
+                                     **ModelLauncher.GroupOptions())
+        ModelLauncher.Started(self.proc.pid)
+        self.lines = queue.Queue()
+        thread = threading.Thread(target=self.Read, args=(self.proc.stdout, self.lines))
+        thread.daemon = True
+        thread.start()
+
+    def Read(self, stdout, lines):
+        "Reader thread: pass model output lines on, then None at end of file"
+        for line in stdout:
+            lines.put(line)
+        lines.put(None)
+
+    def Run(self, directory, output=subprocess.PIPE, timeout=None):
+        """Simulate the feature whose inputs are in directory.  Model output is
+        returned as stdout if output is subprocess.PIPE, otherwise written to
+        output.  Returns a subprocess.CompletedProcess.  If the model has not
+        answered DONE within timeout seconds it is killed and
+        subprocess.TimeoutExpired is raised.  A killed or exited model is
+        restarted by the next Run."""
+        if self.proc is not None and self.proc.poll() is not None:
+            self.Exited()
+        if self.proc is None:
+            self.Start()
+        chunks = []
+        returncode = None
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        try:
+            self.proc.stdin.write('RUN %s\n' % directory)
+            self.proc.stdin.flush()
+            while True:
+                wait = None
+                if deadline is not None:
+                    wait = max(deadline - time.monotonic(), 0.0)
+                line = self.lines.get(timeout=wait)
+                if line is None: #Model exited
+                    returncode = self.Exited()
+                    break
+                if line.startswith('DONE'):
+                    status = line[4:].strip()
+                    returncode = int(status) if status.lstrip('-').isdigit() else 0
+                    break
+                chunks.append(line)
+        except queue.Empty:
+            self.Kill()
+            raise subprocess.TimeoutExpired(self.command, timeout, ''.join(chunks))
+        except (IOError, OSError): #Model exited before reading the request
+            returncode = self.Exited()
+        stdout = ''.join(chunks)
+        if output == subprocess.PIPE:
+            return subprocess.CompletedProcess(self.command, returncode, stdout, '')
+        if output != subprocess.DEVNULL:
+            output.write(stdout.encode('utf-8'))
+        return subprocess.CompletedProcess(self.command, returncode)
+
+    def Exited(self):
+        "Reap a model that exited by itself and return its exit status"
+        returncode = self.proc.wait()
+        ModelLauncher.Ended(self.proc.pid)
+        self.proc = None
+        return returncode
+
+    def Kill(self):
+        ModelLauncher.KillGroup(self.proc.pid)
+        self.proc.wait()
+        ModelLauncher.Ended(self.proc.pid)
+        self.proc = None
+
+    def Stop(self, timeout=10):
+        "Ask the model to exit by closing its stdin, killing it if it does not"
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout)
+            ModelLauncher.Ended(self.proc.pid)
+            self.proc = None
+        except (IOError, OSError, subprocess.TimeoutExpired):
+            self.Kill()
@@ -0,0 +1,120 @@
+"""
+/***************************************************************************
+Name                 : Geospatial Simulation
+Description          : Geospatial tool for managing point-based simulation models
+Date                 : 05/Dec/11
+copyright            : (C) 2011 by Dr. Kelly Thorp, USDA-ARS
+email                : kelly.thorp@ars.usda.gov
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from builtins import object
+import hashlib
+import json
+import os
+import tempfile
+
+class ResultCache(object):
+    """On-disk cache of parsed model outputs keyed by a hash of the rendered
+    model inputs.  Entries are evicted least recently used first once the
+    cache grows past maxsize bytes.  Several processes may share a cache
+    directory.
+
+    Inputs:
+    directory -- Cache directory, created if missing
+    maxsize   -- Size limit of the cache in bytes"""
+
+    def __init__(self, directory, maxsize=1024*1024*1024):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.size = None
+
+    def Key(self, parts):
+        "Return the cache key for a list of strings"
+        h = hashlib.sha256()
+        for part in parts:
+            data = part.encode('utf-8', 'surrogateescape')
+            h.update(str(len(data)).encode('ascii') + b':')
+            h.update(data)
+        return h.hexdigest()
+
+    def Path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def Get(self, key):
+        "Return the cached [(attribute, value)] for key, None on a miss"
+        path = self.Path(key)
+        try:
+            f = open(path, 'r')
+            outputs = json.load(f)
+            f.close()
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            os.utime(path, None) #Mark as recently used
+        except OSError:
+            pass
+        return [(attribute, value) for attribute, value in outputs]
+
+    def Put(self, key, outputs):
+        "Store [(attribute, value)] for key"
+        os.makedirs(self.directory, exist_ok=True)
+        data = json.dumps(outputs)
+        #Write to a temporary file first so readers never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        f = os.fdopen(fd, 'w')
+        f.write(data)
+        f.close()
+        os.replace(tmp, self.Path(key))
+        if self.size is None:
+            self.size = self.Scan()[0]
+        else:
+            self.size += len(data)
+        if self.size > self.maxsize:
+            self.Evict()
+
+    def Scan(self):
+        "Return (total size, [(mtime, size, path)]) of the cache entries"
+        total = 0
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            total += st.st_size
+            entries.append((st.st_mtime, st.st_size, path))
+        return total, entries
+
+    def Evict(self):
+        "Remove least recently used entries until the cache is below 90% of maxsize"
+        total, entries = self.Scan()
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= 0.9 * self.maxsize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self.size = total
+
+    def Clear(self):
+        "Remove all cache entries"
+        if os.path.exists(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith('.json') or name.endswith('.tmp'):
+                    os.remove(os.path.join(self.directory, name))
+        self.size = 0
@@ -0,0 +1,79 @@
+"""
+/***************************************************************************
+Name                 : Geospatial Simulation
+Description          : Geospatial tool for managing point-based simulation models
+Date                 : 05/Dec/11
+copyright            : (C) 2011 by Dr. Kelly Thorp, USDA-ARS
+email                : kelly.thorp@ars.usda.gov
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from builtins import object
+import json
+import os
+
+class RunJournal(object):
+    """Append-only journal of completed features and their parsed outputs.
+    One JSON record per line: {"fid": fid, "attr": [[field index, value], ...]}.
+    A record torn by a crash is ignored when the journal is read back."""
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def Read(self):
+        "Return {fid : {field index : value}} for every complete record"
+        done = {}
+        if not os.path.exists(self.path):
+            return done
+        f = open(self.path, 'r')
+        for line in f:
+            try:
+                record = json.loads(line)
+                attr = {}
+                for bfindx, value in record['attr']:
+                    attr.update({bfindx:value})
+                done.update({record['fid']:attr})
+            except (ValueError, KeyError, TypeError):
+                continue
+        f.close()
+        return done
+
+    def Open(self, append=False):
+        "Open the journal for writing, keeping existing records if append"
+        if append:
+            self.f = open(self.path, 'a')
+            #Terminate a record torn by a crash so new records parse
+            if self.f.tell() > 0:
+                f = open(self.path, 'rb')
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self.f.write('\n')
+                f.close()
+        else:
+            self.f = open(self.path, 'w')
+
+    def Write(self, fid, attr):
+        "Record a completed feature.  Flushed so it survives a crash of this process."
+        items = [[bfindx, attr[bfindx]] for bfindx in sorted(attr.keys())]
+        self.f.write(json.dumps({'fid':fid, 'attr':items}) + '\n')
+        self.f.flush()
+
+    def Sync(self):
+        "Force journal records to disk"
+        if self.f is not None:
+            os.fsync(self.f.fileno())
+
+    def Close(self):
+        if self.f is not None:
+            self.Sync()
+            self.f.close()
+            self.f = None
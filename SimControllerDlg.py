@@ -18,14 +18,15 @@ email                : kelly.thorp@ars.usda.gov
 """
 from __future__ import absolute_import
 from builtins import str
-from builtins import range
-from qgis.PyQt.QtCore import Qt, pyqtSlot, QVariant 
+from qgis.PyQt.QtCore import QSettings, Qt, pyqtSlot
 from qgis.PyQt.QtWidgets import QApplication, QDialog, QFileDialog, QMessageBox
-from qgis.core import QgsField
 from .Ui_SimControllerDlg import Ui_SimControllerDlg
 import os
-import subprocess
 from . import ControlFile
+from . import ModelLog
+from . import ProgressReporter
+from . import SimEngine
+from . import StageTimer
 
 # create the dialog for SimControllerDlg
 class SimControllerDlg(QDialog):
@@ -73,13 +74,6 @@ class SimControllerDlg(QDialog):
                 QMessageBox.critical(self,'Simulation Controller','Error reading control file.')
                 return 1 
                     
-        #Set working directory
-        if not os.path.exists(self.cfile.ModelDirectory):
-            QMessageBox.critical(self,'Simulation Controller','Model directory does not exist.')
-            return 1
-        else:
-            os.chdir(self.cfile.ModelDirectory)
-
         #Get base layer
         count = 0
         for i in self.layers:
@@ -94,77 +88,18 @@ class SimControllerDlg(QDialog):
             QMessageBox.critical(self,'Simulation Controller','Found more than one layer with base layer name.')
             return 1
 
-        #Check template files
-        for key in sorted(self.cfile.TemplateInput.keys()):
-            if not os.path.exists(self.cfile.TemplateInput[key][0]):
-                QMessageBox.critical(self,'Simulation Controller',
-                                     'File does not exist: %s' % self.cfile.TemplateInput[key][0])
-                return 1
-            else:
-                f = open(self.cfile.TemplateInput[key][0], 'r')
-                lines = f.readlines()
-                f.close()
-                if lines[0][0:41] != 'Geospatial Simulation Template (GST) File':
-                    QMessageBox.critical(self, 'Simulation Controller', 'Check template file.')
-                    return 1
-        
-        #Check for input attributes in base layer
-        for key in sorted(self.cfile.AttributeCode.keys()):
-            bfindx = self.bprovider.fieldNameIndex(self.cfile.AttributeCode[key][0])
-            if bfindx < 0:
-                QMessageBox.critical(self,'Simulation Controller',
-                                     'Missing attribute in base layer: %s' % self.cfile.AttributeCode[key][0])
-                return 1
-                
-        #Check instruction files
-        for key in sorted(self.cfile.InstructionOutput.keys()):
-            if not os.path.exists(self.cfile.InstructionOutput[key][0]):
-                QMessageBox.critical(self,'Simulation Controller',
-                                     'File does not exist: %s' % self.cfile.InstructionOutput[key][0])
-                return 1
-            else:
-                f = open(self.cfile.InstructionOutput[key][0], 'r')
-                lines = f.readlines()
-                f.close()
-                if lines[0][0:44] != 'Geospatial Simulation Instruction (GSI) File':
-                    QMessageBox.critical(self, 'Simulation Controller','Check instruction file.')
-                    return 1
-                for line in lines[1:]:
-                    line = line.split(',')
-                    if len(line) < 2:
-                        continue
-                    found = 0
-                    for key in sorted(self.cfile.AttributeType.keys()):
-                        if self.cfile.AttributeType[key][0] == line[0]:
-                            found = 1
-                            break
-                    if not found:
-                        QMessageBox.critical(self, 'Simulation Controller',
-                                              'Check control file for missing output attribute: ' + line[0])
-                        return 1 
-                        
-        #Check for output attributes in base layer.  Add if missing.
-        for key in sorted(self.cfile.AttributeType.keys()):                                              
-            typename = self.cfile.AttributeType[key][1].split('(')[0]
-            length = self.cfile.AttributeType[key][1].split('(')[1]
-            bfindx = self.bprovider.fieldNameIndex(self.cfile.AttributeType[key][0])
-            if bfindx < 0: #Field not found, must add it
-                newfield = QgsField()
-                newfield.setName(self.cfile.AttributeType[key][0])
-                if typename in ['String','string','STRING']:
-                    newfield.setType(QVariant.String)
-                    newfield.setTypeName('String')
-                    newfield.setLength(int(length.split(')')[0]))
-                elif typename in ['Integer', 'integer', 'INTEGER']:
-                    newfield.setType(QVariant.Int)
-                    newfield.setTypeName('Integer')
-                    newfield.setLength(int(length.split(')')[0]))
-                elif typename in ['Real', 'real', 'REAL']:
-                    newfield.setType(QVariant.Double)
-                    newfield.setTypeName('Real')
-                    newfield.setLength(int(length.split('.')[0]))
-                    newfield.setPrecision(int(length.split('.')[1].split(')')[0]))
-                self.bprovider.addAttributes([newfield])
+        #Check model directory, template and instruction files, and attributes
+        self.engine = SimEngine.SimEngine(self.cfile, self.blayer)
+        self.engine.modellog = ModelLog.ModelLog(os.path.abspath(self.cfilename) + '.logs')
+        #Events for trace.json are only kept if GeospatialSimulation/trace is set
+        trace = QSettings().value('GeospatialSimulation/trace', False, type=bool)
+        self.engine.timer = StageTimer.StageTimer(trace)
+        self.progress = ProgressReporter.ProgressReporter(
+            ProgressReporter.BarShow(self.ui.ProgressBar, QApplication.processEvents),
+            timer=self.engine.timer)
+        if self.engine.CheckControlFile():
+            QMessageBox.critical(self,'Simulation Controller',self.engine.error)
+            return 1
                 
         #Enable Run button
         self.ui.btnRun.setEnabled(True)
@@ -173,114 +108,40 @@ class SimControllerDlg(QDialog):
 
     @pyqtSlot()
     def on_btnRun_clicked(self):
+        self.engine.timer.Clear()
+        self.Simulate()
+        self.WriteTiming()
+
+    def Simulate(self):
         
         #Initializations
-        b1 = 0
-        attr={}
-        bfields = self.bprovider.fields()
-        b2 = self.bprovider.featureCount()
+        featids = None
         self.ui.ProgressBar.setValue(0)
         self.setCursor(Qt.WaitCursor)
         if self.ui.cbxOnlySelected.isChecked():
-            selectedIDs = self.blayer.selectedFeatureIds()
-            b2 = len(selectedIDs)
+            featids = self.blayer.selectedFeatureIds()
                  
         #Run simulations
-        for bfeat in self.bprovider.getFeatures(): 
-            
-            if self.ui.cbxOnlySelected.isChecked():
-                if bfeat.id() not in selectedIDs:
-                    continue 
-            
-            b1+=1          
-            #Write model input files
-            for key1 in list(self.cfile.TemplateInput.keys()):
-                f = open(self.cfile.TemplateInput[key1][0], 'r')
-                lines = f.readlines()
-                f.close()
-                lines.pop(0)
-                for key2 in list(self.cfile.AttributeCode.keys()):
-                    bfindx = self.bprovider.fieldNameIndex(self.cfile.AttributeCode[key2][0])
-                    value = bfeat.attribute(self.cfile.AttributeCode[key2][0])
-                    ftype = str(bfields[bfindx].typeName())
-                    code = self.cfile.AttributeCode[key2][1]
-                    for i,line in enumerate(lines):
-                        if ftype in ['String']:
-                            svalue = value.rjust(len(code))
-                        elif ftype in ['Integer','Integer64']:
-                            myfmt = '%' + str(len(code)) + 'd'
-                            svalue = myfmt % int(value)
-                        elif ftype in ['Real','Double']:
-                            if float(value) >= 0:
-                                decnum = len(code) - len(str(int(value))) - 1
-                            elif float(value) < 0:
-                                decnum = len(code) - len(str(int(value))) - 2
-                            myfmt = '%' + str(len(code)) + '.' + str(decnum) + 'f'
-                            svalue = myfmt % round(float(value),decnum)
-                        else:
-                            self.setCursor(Qt.ArrowCursor)
-                            QMessageBox.critical(self, 'Simulation Controller',
-                                                 'ftype not found:' + str(ftype))
-                            return
-                        lines[i] = lines[i].replace(code,svalue)                
-                f = open(self.cfile.TemplateInput[key1][1], 'w')
-                for line in lines:
-                    f.write(line)
-                f.close()
+        self.progress.Start()
+        ret = self.engine.Run(featids, self.progress.Update, self.ui.textBrowser.append)
+        self.progress.Finish()
+        self.summary = self.engine.summary
+        if self.summary is None: #No model run finished
+            self.summary = self.engine.error
+        self.setCursor(Qt.ArrowCursor)
+        if ret:
+            QMessageBox.critical(self, 'Simulation Controller', self.engine.error)
 
-            #Run model
-            self.p = subprocess.run(self.cfile.CommandLine, 
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               shell=True,
-                               text = True)
-            self.ui.textBrowser.append(self.p.stdout)
-            self.ui.textBrowser.append(self.p.stderr)
-            
-            #Read model output files
-            attr.clear()
-            for key in list(self.cfile.InstructionOutput.keys()):
-                f = open(self.cfile.InstructionOutput[key][0], 'r')
-                lines = f.readlines()
-                f.close()
-                lines.pop(0)
-                f = open(self.cfile.InstructionOutput[key][1], 'r', errors='replace')
-                output = f.readlines()
-                f.close()
-                for line in lines:
-                    line = line.split(',')
-                    if len(line) < 2:
-                        continue
-                    rownum = 0
-                    bfindx = self.bprovider.fieldNameIndex(line[0])
-                    for item in line[1:]:
-                        if item[0:4] in ['Plus', 'plus', 'PLUS']:
-                            rownum+=int(item[4:])
-                        elif item[0:4] in ['Find', 'find', 'FIND']:
-                            for i in range(rownum, len(output)):
-                                start = output[i].find(item[4:])
-                                if start >= 0:
-                                    rownum = i
-                                    break
-                        elif item[0:3] in ['Get', 'get', 'GET']:
-                            extents = item[3:].split(':')
-                            extents = [int(i) for i in extents]
-                            value = output[rownum][extents[0]:extents[1]]
-                            attr.update({bfindx:value})
-                        else:
-                            self.setCursor(Qt.ArrowCursor)
-                            QMessageBox.critical(self, 'Simulation Controller', 'Check instruction file commands.')
-                            return
-            result = self.bprovider.changeAttributeValues({bfeat.id():attr})
-            if not result:
-                self.setCursor(Qt.ArrowCursor)
-                QMessageBox.critical(self, 'Simulation Controller', 'Could not change attribute value.')
-                return  
-                                      
-            self.ui.ProgressBar.setValue(float(b1)/float(b2) * 100.0)
-            QApplication.processEvents()
-        
-        self.setCursor(Qt.ArrowCursor)       
+    def WriteTiming(self):
+        """Write the stage timings to timing.txt in the log directory, and to
+        trace.json if the timer keeps a trace"""
+        logdir = self.engine.modellog.directory
+        os.makedirs(logdir, exist_ok=True)
+        f = open(os.path.join(logdir, 'timing.txt'), 'w')
+        f.write(self.engine.timer.Summary() + '\n')
+        f.close()
+        if self.engine.timer.trace:
+            self.engine.timer.WriteTrace(os.path.join(logdir, 'trace.json'))
                                  
     @pyqtSlot()
     def on_btnExit_clicked(self):
@@ -0,0 +1,1047 @@
+"""
+/***************************************************************************
+Name                 : Geospatial Simulation
+Description          : Geospatial tool for managing point-based simulation models
+Date                 : 05/Dec/11
+copyright            : (C) 2011 by Dr. Kelly Thorp, USDA-ARS
+email                : kelly.thorp@ars.usda.gov
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Headless simulation engine.  Runs the template -> model -> instruction loop
+ for every feature of the base layer without the Qt user interface.  Usage:
+
+     python -m GeospatialSimulation.SimEngine control.gsc baselayer.shp
+"""
+from __future__ import absolute_import
+from builtins import str
+from builtins import object
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import QgsField, QgsFeatureRequest
+import argparse
+import asyncio
+import multiprocessing
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from . import ControlFile
+from . import Fingerprints
+from . import ResidentModel
+from . import ResultCache
+from . import RunJournal
+from . import InstructionFile
+from . import ModelLauncher
+from . import ModelLog
+from . import ProgressReporter
+from . import SimWorker
+from . import StageTimer
+from . import TemplateFile
+
+class SimEngine(object):
+    "Run simulations for Geospatial Simulation without the Qt user interface"
+
+    def __init__(self, cfile, blayer):
+        self.cfile = cfile
+        self.blayer = blayer
+        self.bprovider = blayer.dataProvider()
+        self.error = ''
+        self.summary = None
+        self.workers = 1
+        self.commitsize = 1000
+        self.cache = None
+        self.dedupe = False
+        self.journal = None
+        self.resume = False
+        self.asyncjobs = 0
+        self.stream = None
+        self.modellog = None
+        self.timer = None
+        self.timeout = None
+        self.retries = 0
+        self.speculate = 0.0
+        self.resident = None
+        self.stage = None
+        self.link = False
+        self.fifo = False
+        self.pipeline = False
+        self.batch = None
+        self.fingerprints = None
+        self.incremental = False
+        self.modeldir = ''
+        self.templates = {}
+
+    def CheckControlFile(self):
+
+        #Set working directory
+        if not os.path.exists(self.cfile.ModelDirectory):
+            self.error = 'Model directory does not exist.'
+            return 1
+        else:
+            os.chdir(self.cfile.ModelDirectory)
+            self.modeldir = os.getcwd()
+
+        #Check and compile template files
+        codes = {}
+        for key in list(self.cfile.AttributeCode.keys()):
+            codes.update({key:self.cfile.AttributeCode[key][1]})
+        self.templates = {}
+        for key in sorted(self.cfile.TemplateInput.keys()):
+            tfile = TemplateFile.TemplateFile()
+            ret = tfile.ReadFile(self.cfile.TemplateInput[key][0])
+            if ret == 1:
+                self.error = 'File does not exist: %s' % self.cfile.TemplateInput[key][0]
+                return 1
+            elif ret:
+                self.error = 'Check template file.'
+                return 1
+            tfile.Compile(codes)
+            self.templates.update({key:tfile})
+
+        #Check for input attributes in base layer
+        for key in sorted(self.cfile.AttributeCode.keys()):
+            bfindx = self.bprovider.fieldNameIndex(self.cfile.AttributeCode[key][0])
+            if bfindx < 0:
+                self.error = 'Missing attribute in base layer: %s' % self.cfile.AttributeCode[key][0]
+                return 1
+
+        #Check and compile instruction files
+        self.instructions = {}
+        for key in sorted(self.cfile.InstructionOutput.keys()):
+            ifile = InstructionFile.InstructionFile()
+            ret = ifile.ReadFile(self.cfile.InstructionOutput[key][0])
+            if ret == 1:
+                self.error = 'File does not exist: %s' % self.cfile.InstructionOutput[key][0]
+                return 1
+            elif ret == 2:
+                self.error = 'Check instruction file.'
+                return 1
+            elif ret:
+                self.error = 'Check instruction file commands.'
+                return 1
+            for attribute in ifile.Attributes():
+                found = 0
+                for key2 in sorted(self.cfile.AttributeType.keys()):
+                    if self.cfile.AttributeType[key2][0] == attribute:
+                        found = 1
+                        break
+                if not found:
+                    self.error = 'Check control file for missing output attribute: ' + attribute
+                    return 1
+            self.instructions.update({key:ifile})
+
+        #Check batch settings
+        self.batch, error = SimWorker.BatchSettings(self.cfile)
+        if error:
+            self.error = error
+            return 1
+
+        #Check for output attributes in base layer.  Add if missing.
+        for key in sorted(self.cfile.AttributeType.keys()):
+            typename = self.cfile.AttributeType[key][1].split('(')[0]
+            length = self.cfile.AttributeType[key][1].split('(')[1]
+            bfindx = self.bprovider.fieldNameIndex(self.cfile.AttributeType[key][0])
+            if bfindx < 0: #Field not found, must add it
+                newfield = QgsField()
+                newfield.setName(self.cfile.AttributeType[key][0])
+                if typename in ['String','string','STRING']:
+                    newfield.setType(QVariant.String)
+                    newfield.setTypeName('String')
+                    newfield.setLength(int(length.split(')')[0]))
+                elif typename in ['Integer', 'integer', 'INTEGER']:
+                    newfield.setType(QVariant.Int)
+                    newfield.setTypeName('Integer')
+                    newfield.setLength(int(length.split(')')[0]))
+                elif typename in ['Real', 'real', 'REAL']:
+                    newfield.setType(QVariant.Double)
+                    newfield.setTypeName('Real')
+                    newfield.setLength(int(length.split('.')[0]))
+                    newfield.setPrecision(int(length.split('.')[1].split(')')[0]))
+                self.bprovider.addAttributes([newfield])
+
+        return 0
+
+    def Run(self, featids=None, progress=None, log=None):
+        """Simulate the features in featids (all features if None).
+        progress(done, total) and log(text) are optional callbacks; log receives
+        a bounded summary of each model run."""
+
+        #Initializations
+        self.summary = None
+        if self.batch is not None and self.fifo:
+            self.error = 'Named pipes cannot be used with batch runs.'
+            return 1
+        if self.Scratch() and self.CheckPaths():
+            return 1
+        b1 = 0
+        b2 = self.bprovider.featureCount()
+        if featids is not None:
+            featids = list(featids)
+            b2 = len(featids)
+        tables = self.FieldTables()
+        if tables is None:
+            return 1
+        formats, findex = tables
+
+        #Replay features completed in an earlier run from the journal
+        writer = ResultWriter(self.bprovider, self.commitsize, self.journal, self.timer)
+        done = {}
+        if self.journal is not None:
+            if self.resume:
+                done = self.journal.Read()
+                if featids is not None:
+                    featset = set(featids)
+                    done = dict([(fid, done[fid]) for fid in done if fid in featset])
+                for fid in list(done.keys()):
+                    if not writer.Add(fid, done[fid]):
+                        self.error = 'Could not change attribute value.'
+                        return 1
+                b1+=len(done)
+            self.journal.Open(self.resume)
+
+        #Leave out features whose inputs are unchanged since their last run
+        tasks = self.Features(featids, formats, done)
+        known = {}
+        current = {}
+        unchanged = []
+        if self.fingerprints is not None:
+            known = self.fingerprints.Read()
+            salt = Fingerprints.Salt(self.cfile, self.templates, self.instructions, formats)
+            tasks = self.Changed(tasks, salt, known, current, unchanged)
+
+        #Run simulations
+        groups = {}
+        if self.dedupe:
+            tasks, groups = self.Group(tasks)
+        if self.batch is not None: #Batches run one at a time or in worker processes
+            if self.workers > 1:
+                results = self.RunParallel(list(tasks), formats, findex)
+            else:
+                results = self.RunSerial(tasks, formats, findex)
+        elif self.asyncjobs > 0:
+            results = self.RunAsync(list(tasks), formats, findex)
+        elif self.workers > 1:
+            results = self.RunParallel(list(tasks), formats, findex)
+        elif self.pipeline:
+            #Base layer features are read here, not on the render thread
+            results = self.RunPipeline(list(tasks), formats, findex)
+        else:
+            results = self.RunSerial(tasks, formats, findex)
+        ret = 0
+        timedout = []
+        written = {}
+        try:
+            for fid, attr, summary, error in results:
+                fids = groups.get(fid, [fid])
+                b1+=len(fids)
+                self.summary = summary
+                if log is not None and summary is not None:
+                    log(summary)
+                if attr is None and error == SimWorker.TIMEDOUT:
+                    #Leave the feature unsimulated and carry on
+                    timedout.extend(fids)
+                    if progress is not None:
+                        progress(b1 + len(unchanged), b2)
+                    continue
+                if attr is None:
+                    self.error = error
+                    ret = 1
+                    break
+                for fid in fids:
+                    if self.journal is not None:
+                        self.journal.Write(fid, attr)
+                    if not writer.Add(fid, attr):
+                        ret = 2
+                        break
+                    if fid in current:
+                        written.update({fid:current[fid]})
+                if ret:
+                    break
+                if progress is not None:
+                    progress(b1 + len(unchanged), b2)
+        finally:
+            #Commit the results of all completed features, also after a failure
+            results.close()
+            if not writer.Flush():
+                ret = 2
+            if self.journal is not None:
+                self.journal.Close()
+            if self.fingerprints is not None and ret != 2 and written:
+                known.update(written)
+                self.fingerprints.Write(known)
+        if progress is not None and unchanged and not ret:
+            progress(b1 + len(unchanged), b2)
+        if ret == 2:
+            self.error = 'Could not change attribute value.'
+            return 1
+        if not ret and timedout:
+            self.error = 'Model timed out for %d features: %s' % (len(timedout),
+                                                                  ','.join([str(fid) for fid in sorted(timedout)]))
+            return 1
+        return ret
+
+    def Render(self, directory, featids=None, progress=None):
+        """Render the model inputs of the features in featids (all features if
+        None) into directory/fid without running the model, in self.workers
+        processes.  directory/features.txt lists the rendered fids, one per
+        line, for running the models elsewhere."""
+        if self.CheckPaths():
+            return 1
+        tables = self.FieldTables()
+        if tables is None:
+            return 1
+        formats, findex = tables
+        os.makedirs(directory, exist_ok=True)
+        tasks = list(self.Features(featids, formats))
+        b1 = 0
+        b2 = len(tasks)
+        fids = []
+        results = self.Decks(SimWorker.RenderDeckProcess, tasks, formats, findex, directory)
+        try:
+            for fid, events in results:
+                if events:
+                    self.timer.Add(events)
+                fids.append(fid)
+                b1+=1
+                if progress is not None:
+                    progress(b1, b2)
+        finally:
+            results.close()
+        f = open(os.path.join(directory, 'features.txt'), 'w')
+        f.write(''.join(['%d\n' % fid for fid in sorted(fids)]))
+        f.close()
+        return 0
+
+    def Ingest(self, directory, featids=None, progress=None):
+        """Read the model outputs in directory/fid for the features rendered
+        there by Render, once their models have run, and write the results to
+        the base layer.  Only features in featids are read if given."""
+        if self.CheckPaths():
+            return 1
+        if not os.path.isdir(directory):
+            self.error = 'Directory not found: %s' % directory
+            return 1
+        tables = self.FieldTables()
+        if tables is None:
+            return 1
+        formats, findex = tables
+        fids = sorted([int(name) for name in os.listdir(directory)
+                       if name.isdigit() and os.path.isdir(os.path.join(directory, name))])
+        if featids is not None:
+            featset = set(featids)
+            fids = [fid for fid in fids if fid in featset]
+        b1 = 0
+        b2 = len(fids)
+        writer = ResultWriter(self.bprovider, self.commitsize, None, self.timer)
+        results = self.Decks(SimWorker.IngestDeckProcess, fids, formats, findex, directory)
+        ret = 0
+        missing = []
+        try:
+            for fid, attr, error, events in results:
+                if events:
+                    self.timer.Add(events)
+                b1+=1
+                if attr is None:
+                    missing.append(fid)
+                elif not writer.Add(fid, attr):
+                    ret = 2
+                    break
+                if progress is not None:
+                    progress(b1, b2)
+        finally:
+            results.close()
+            if not writer.Flush():
+                ret = 2
+        if ret:
+            self.error = 'Could not change attribute value.'
+            return 1
+        if missing:
+            self.error = 'No model outputs for %d features: %s' % (len(missing),
+                                                                   ','.join([str(fid) for fid in sorted(missing)]))
+            return 1
+        return 0
+
+    def CheckPaths(self):
+        """Check that the input and output files are inside the model directory,
+        as needed to run in scratch copies of it and by Render and Ingest"""
+        names = [self.cfile.TemplateInput[key][1] for key in self.cfile.TemplateInput]
+        names.extend([self.cfile.InstructionOutput[key][1] for key in self.cfile.InstructionOutput])
+        if self.batch is not None and self.batch['Mode'] == 'files':
+            names.append(self.batch['BatchFile'])
+        for name in names:
+            if os.path.relpath(os.path.join(self.modeldir, name), self.modeldir).startswith(os.pardir):
+                self.error = 'Input and output files must be in the model directory: %s' % name
+                return 1
+        return 0
+
+    def Decks(self, func, items, formats, findex, directory):
+        """Yield func(item) for the process pool tasks RenderDeckProcess and
+        IngestDeckProcess, in self.workers processes or here if it is 1"""
+        initargs = (self.cfile, self.templates, self.instructions, formats, findex,
+                    self.modeldir, directory, self.timer is not None, self.Tracing())
+        if self.workers <= 1:
+            SimWorker.InitDeckProcess(*initargs)
+            for item in items:
+                yield func(item)
+            return
+        pool = self.Pool(SimWorker.InitDeckProcess, initargs)
+        try:
+            for result in pool.imap_unordered(func, items, 64):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def FieldTables(self):
+        """Resolve the base layer fields once per run.  Returns a CodeFormat for
+        each input attribute code and the field index of each output attribute,
+        None on error."""
+        bfields = self.bprovider.fields()
+        formats = {}
+        for key in list(self.cfile.AttributeCode.keys()):
+            bfindx = self.bprovider.fieldNameIndex(self.cfile.AttributeCode[key][0])
+            ftype = str(bfields[bfindx].typeName())
+            try:
+                formats.update({key:TemplateFile.CodeFormat(bfindx, ftype,
+                                                            len(self.cfile.AttributeCode[key][1]))})
+            except ValueError as e:
+                self.error = str(e)
+                return None
+        findex = {}
+        for key in list(self.cfile.AttributeType.keys()):
+            bfindx = self.bprovider.fieldNameIndex(self.cfile.AttributeType[key][0])
+            findex.update({self.cfile.AttributeType[key][0]:bfindx})
+        return formats, findex
+
+    def Features(self, featids, formats, skip={}):
+        """Yield (fid, {AttributeCode key : value}) for the features to simulate,
+        leaving out fids in skip.  Only the input attributes are fetched,
+        without geometry."""
+        featreq = QgsFeatureRequest()
+        featreq.setFlags(QgsFeatureRequest.NoGeometry)
+        featreq.setSubsetOfAttributes([formats[key].index for key in list(formats.keys())])
+        if featids is not None:
+            featreq.setFilterFids(featids)
+        for bfeat in self.bprovider.getFeatures(featreq):
+            if bfeat.id() in skip:
+                continue
+            values = {}
+            for key in list(formats.keys()):
+                values.update({key:bfeat.attribute(formats[key].index)})
+            yield (bfeat.id(), values)
+
+    def Changed(self, tasks, salt, known, current, unchanged):
+        """Fingerprint each task into current.  With incremental runs, tasks
+        whose fingerprint matches known are appended to unchanged instead of
+        being yielded."""
+        for fid, values in tasks:
+            fingerprint = Fingerprints.Fingerprint(salt, values)
+            current.update({fid:fingerprint})
+            if self.incremental and known.get(fid) == fingerprint:
+                unchanged.append(fid)
+                continue
+            yield (fid, values)
+
+    def Group(self, tasks):
+        """Group features with identical input attribute values.  Returns one
+        task per group and {representative fid : [fids in the group]}."""
+        keys = {}
+        groups = {}
+        unique = []
+        for fid, values in tasks:
+            key = tuple([values[k] for k in sorted(values.keys())])
+            if key in keys:
+                groups[keys[key]].append(fid)
+            else:
+                keys.update({key:fid})
+                groups.update({fid:[fid]})
+                unique.append((fid, values))
+        return unique, groups
+
+    def RunSerial(self, tasks, formats, findex):
+        """Simulate features one after another in the model directory, or in
+        a staging copy of it if stage is set"""
+        root = None
+        workdir = self.modeldir
+        if self.stage or self.fifo:
+            root = self.ScratchRoot()
+            workdir = SimWorker.MakeScratch(self.modeldir, root, self.Written())
+        worker = SimWorker.SimWorker(self.cfile, self.templates, self.instructions, formats,
+                                     findex, self.modeldir, workdir, self.cache,
+                                     self.modellog, self.timer)
+        worker.timeout = self.timeout
+        worker.retries = self.retries
+        worker.fifo = self.fifo
+        if self.resident:
+            worker.resident = ResidentModel.ResidentModel(self.resident, workdir)
+        try:
+            if self.batch is not None:
+                for batch in self.Batches(tasks):
+                    attrs = worker.SimulateBatch(batch, self.batch)
+                    for result in SimWorker.BatchResults(batch, attrs, worker.summary, worker.error):
+                        yield result
+                return
+            for fid, values in tasks:
+                attr = worker.Simulate(fid, values)
+                yield (fid, attr, worker.summary, worker.error)
+        finally:
+            if worker.resident is not None:
+                worker.resident.Stop()
+            if root is not None:
+                shutil.rmtree(root, ignore_errors=True)
+
+    def RunPipeline(self, tasks, formats, findex):
+        """Run one model at a time, but render the inputs of the next feature
+        and parse the outputs of the previous one while the model runs.  The
+        render, model and parse stages each have a thread, pass features on
+        through queues holding at most one feature and rotate through three
+        scratch copies of the model directory.  tasks must be a list: QGIS
+        data providers may only be used from the calling thread."""
+        root = self.ScratchRoot()
+        written = self.Written()
+        resident = None
+        if self.resident:
+            resident = ResidentModel.ResidentModel(self.resident, self.modeldir)
+        free = queue.Queue()
+        for i in range(3):
+            worker = SimWorker.SimWorker(self.cfile, self.templates, self.instructions, formats,
+                                         findex, self.modeldir,
+                                         SimWorker.MakeScratch(self.modeldir, root, written),
+                                         self.cache, self.modellog, self.timer)
+            worker.tid = i + 1
+            worker.timeout = self.timeout
+            worker.retries = self.retries
+            worker.fifo = self.fifo
+            worker.resident = resident #Only one model runs at a time
+            free.put(worker)
+        running = queue.Queue(1)
+        parsing = queue.Queue(1)
+        results = queue.Queue(1)
+        stop = threading.Event()
+        threads = [threading.Thread(target=self.Stage, args=(self.RenderStage, results, stop,
+                                                             tasks, free, running)),
+                   threading.Thread(target=self.Stage, args=(self.ModelStage, results, stop,
+                                                             running, parsing)),
+                   threading.Thread(target=self.Stage, args=(self.ParseStage, results, stop,
+                                                             parsing, free))]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                result = results.get()
+                if result is None:
+                    break
+                if isinstance(result, BaseException):
+                    raise result
+                yield result
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            if resident is not None:
+                resident.Stop()
+            shutil.rmtree(root, ignore_errors=True)
+
+    def Stage(self, target, results, stop, *args):
+        "Thread of a RunPipeline stage.  Errors are passed on as results."
+        try:
+            target(results, stop, *args)
+        except BaseException as e:
+            Put(results, e, stop)
+
+    def RenderStage(self, results, stop, tasks, free, running):
+        for fid, values in tasks:
+            worker = Get(free, stop)
+            if worker is None:
+                return
+            attr = worker.Begin(values)
+            if attr is not None: #Result cache hit
+                Put(results, (fid, attr, None, worker.error), stop)
+                free.put(worker)
+            else:
+                Put(running, (fid, worker), stop)
+        Put(running, None, stop)
+
+    def ModelStage(self, results, stop, running, parsing):
+        while True:
+            item = Get(running, stop)
+            if item is None:
+                break
+            fid, worker = item
+            t0 = time.perf_counter()
+            worker.RunModel(fid)
+            worker.Time('model', t0)
+            Put(parsing, item, stop)
+        Put(parsing, None, stop)
+
+    def ParseStage(self, results, stop, parsing, free):
+        while True:
+            item = Get(parsing, stop)
+            if item is None:
+                break
+            fid, worker = item
+            if worker.p.returncode is None:
+                Put(results, (fid, None, worker.summary, SimWorker.TIMEDOUT), stop)
+            else:
+                Put(results, (fid, worker.End(), worker.summary, worker.error), stop)
+            free.put(worker)
+        Put(results, None, stop)
+
+    def Batches(self, tasks):
+        "Split tasks into lists of BatchSize tasks"
+        batch = []
+        for task in tasks:
+            batch.append(task)
+            if len(batch) == self.batch['BatchSize']:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def Scratch(self):
+        "True if the model runs in scratch copies of the model directory"
+        return (self.workers > 1 or self.asyncjobs > 0 or self.pipeline or
+                bool(self.stage) or self.fifo)
+
+    def ScratchRoot(self):
+        "Make a directory for scratch copies of the model, in stage if set"
+        return tempfile.mkdtemp(prefix='geosim', dir=self.stage or None)
+
+    def Written(self):
+        """Files written by each run if link is set, None otherwise.  All other
+        model files are then linked into the scratch copies instead of copied."""
+        if not self.link:
+            return None
+        return SimWorker.WrittenFiles(self.cfile, self.modeldir)
+
+    def Tracing(self):
+        "True if the timer keeps events for a trace, so worker timers must too"
+        return self.timer is not None and self.timer.trace
+
+    def RunParallel(self, tasks, formats, findex):
+        """Simulate features in a pool of worker processes.  Each worker runs
+        the model in its own scratch copy of the model directory.  If
+        speculate is set, once all remaining features are running, idle
+        workers rerun features that have run speculate times longer than the
+        median feature and the first result is used."""
+        root = self.ScratchRoot()
+        os.makedirs(SimWorker.PidDirectory(root))
+        pool = self.Pool(SimWorker.InitProcess,
+                         (self.cfile, self.templates, self.instructions,
+                          formats, findex, self.modeldir, root, self.cache, self.modellog,
+                          self.timer is not None, self.timeout, self.retries, self.resident,
+                          self.Written(), self.fifo, self.Tracing()))
+        done = queue.Queue()
+        pending = {} #{fid : task} of features without a result
+        runs = {} #{fid : number of runs in progress}
+        since = {} #{fid : time the feature was known to be running}
+        elapsed = []
+        try:
+            if self.batch is not None:
+                batches = [(batch, self.batch) for batch in self.Batches(tasks)]
+                for results, events in pool.imap_unordered(SimWorker.SimulateBatchProcess, batches):
+                    if events:
+                        self.timer.Add(events)
+                    for result in results:
+                        yield result
+                return
+            for task in tasks:
+                pending.update({task[0]:task})
+                runs.update({task[0]:1})
+                pool.apply_async(SimWorker.SimulateProcess, (task,),
+                                 callback=done.put, error_callback=done.put)
+            while pending:
+                try:
+                    result = done.get(timeout=1.0 if self.speculate else None)
+                except queue.Empty:
+                    result = None
+                if isinstance(result, BaseException):
+                    raise result
+                if result is not None:
+                    fid, attr, summary, error, events, seconds = result
+                    runs[fid]-=1
+                    if events:
+                        self.timer.Add(events)
+                    if fid in pending: #Otherwise a slower copy of a finished feature
+                        del pending[fid]
+                        elapsed.append(seconds)
+                        yield (fid, attr, summary, error)
+                if self.speculate:
+                    self.Speculate(pool, done, pending, runs, since, elapsed)
+        finally:
+            pool.terminate()
+            pool.join()
+            #Workers die with the pool, the models they were running do not
+            ModelLauncher.KillRecorded(SimWorker.PidDirectory(root))
+            shutil.rmtree(root, ignore_errors=True)
+
+    def Pool(self, initializer, initargs):
+        "Start a pool of self.workers processes"
+        ctx = multiprocessing.get_context()
+        if sys.platform == 'win32':
+            #Inside QGIS sys.executable is the QGIS application, not Python
+            ctx = multiprocessing.get_context('spawn')
+            ctx.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
+        return ctx.Pool(self.workers, initializer, initargs)
+
+    def Speculate(self, pool, done, pending, runs, since, elapsed):
+        "Start a second run of straggling features on idle workers of RunParallel"
+        busy = sum(runs.values())
+        if busy > self.workers or not elapsed:
+            return
+        #Tasks are started in order, so every feature without a result is running
+        now = time.perf_counter()
+        median = sorted(elapsed)[len(elapsed) // 2]
+        for fid in pending:
+            since.setdefault(fid, now)
+            if busy < self.workers and runs[fid] == 1 and now - since[fid] > self.speculate * median:
+                pool.apply_async(SimWorker.SimulateProcess, (pending[fid],),
+                                 callback=done.put, error_callback=done.put)
+                runs[fid]+=1
+                busy+=1
+
+    def RunAsync(self, tasks, formats, findex):
+        """Keep up to asyncjobs model processes in flight from one process.  An
+        asyncio event loop in a background thread renders inputs, launches the
+        models and parses outputs; each slot has its own scratch copy of the
+        model directory."""
+        root = self.ScratchRoot()
+        written = self.Written()
+        workers = []
+        for i in range(self.asyncjobs):
+            scratch = SimWorker.MakeScratch(self.modeldir, root, written)
+            modellog = self.modellog
+            if modellog is not None:
+                modellog = modellog.Copy('slot%d' % i)
+            workers.append(SimWorker.SimWorker(self.cfile, self.templates, self.instructions, formats,
+                                               findex, self.modeldir, scratch, self.cache, modellog,
+                                               self.timer))
+            workers[-1].tid = i + 1
+            workers[-1].timeout = self.timeout
+            workers[-1].retries = self.retries
+            workers[-1].fifo = self.fifo
+            if self.resident:
+                workers[-1].resident = ResidentModel.ResidentModel(self.resident, scratch)
+        command = ModelLauncher.ModelCommand(self.cfile.CommandLine, self.modeldir)
+        launcher = ModelLauncher.AsyncLauncher(command, self.asyncjobs, self.stream, self.timer)
+        results = queue.Queue()
+        stop = threading.Event()
+        thread = threading.Thread(target=self.Dispatch,
+                                  args=(tasks, workers, launcher, results, stop))
+        thread.start()
+        try:
+            while True:
+                result = results.get()
+                if result is None:
+                    break
+                if isinstance(result, BaseException):
+                    raise result
+                yield result
+        finally:
+            stop.set()
+            thread.join()
+            for worker in workers:
+                if worker.resident is not None:
+                    worker.resident.Stop()
+            shutil.rmtree(root, ignore_errors=True)
+
+    def Dispatch(self, tasks, workers, launcher, results, stop):
+        "Event loop thread for RunAsync.  Puts results, then None when finished."
+        try:
+            asyncio.run(self.DispatchAsync(tasks, workers, launcher, results, stop))
+        except BaseException as e:
+            results.put(e)
+        results.put(None)
+
+    async def DispatchAsync(self, tasks, workers, launcher, results, stop):
+        free = asyncio.Queue()
+        for worker in workers:
+            free.put_nowait(worker)
+        running = set()
+        for fid, values in tasks:
+            worker = await free.get()
+            if stop.is_set():
+                break
+            attr = worker.Begin(values)
+            if attr is not None: #Result cache hit
+                results.put((fid, attr, None, worker.error))
+                free.put_nowait(worker)
+                continue
+            job = asyncio.ensure_future(self.SimulateAsync(fid, worker, launcher, results, free))
+            running.add(job)
+            job.add_done_callback(running.discard)
+        if running:
+            await asyncio.wait(running)
+
+    async def SimulateAsync(self, fid, worker, launcher, results, free):
+        "Run the model for one feature prepared by worker.Begin and parse its outputs"
+        try:
+            t0 = time.perf_counter()
+            if worker.resident is not None:
+                #Resident models answer over a pipe; wait for them in a thread
+                await asyncio.get_running_loop().run_in_executor(None, worker.RunModel, fid)
+            else:
+                await self.LaunchAsync(fid, worker, launcher)
+            worker.Time('model', t0)
+            if worker.p.returncode is None:
+                results.put((fid, None, worker.summary, SimWorker.TIMEDOUT))
+            else:
+                results.put((fid, worker.End(), worker.summary, worker.error))
+        except Exception as e:
+            results.put(e)
+        finally:
+            free.put_nowait(worker)
+
+    async def LaunchAsync(self, fid, worker, launcher):
+        "Asynchronous SimWorker.RunModel"
+        for attempt in range(worker.retries + 1):
+            target = worker.OpenLog(fid)
+            output = None
+            if target != subprocess.PIPE:
+                output = target
+            fifo = worker.StartFifo()
+            try:
+                worker.p = await launcher.Launch(worker.workdir, fid, output, worker.timeout)
+            except subprocess.TimeoutExpired as e:
+                worker.p = subprocess.CompletedProcess(e.cmd, None)
+            finally:
+                worker.EndFifo(fifo)
+            worker.CloseLog(target, fid)
+            if worker.p.returncode is not None:
+                break
+
+def Put(q, item, stop):
+    "Put item on a bounded queue unless stop is set while waiting"
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+def Get(q, stop):
+    "Get an item from a queue, None if stop is set while waiting"
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return None
+
+class ResultWriter(object):
+    """Buffer simulation results and write them to the base layer data provider
+    in chunks.  Each chunk is one changeAttributeValues call, which the OGR
+    provider commits as a single transaction where the format supports it.
+    If a RunJournal is given it is synced to disk before each chunk.  If a
+    StageTimer is given each chunk is timed as the write stage."""
+
+    def __init__(self, bprovider, commitsize=1000, journal=None, timer=None):
+        self.bprovider = bprovider
+        self.commitsize = commitsize
+        self.journal = journal
+        self.timer = timer
+        self.buffer = {}
+
+    def Add(self, fid, attr):
+        "Buffer {field index : value} for fid.  Returns False if a write failed."
+        self.buffer.update({fid:attr})
+        if len(self.buffer) >= self.commitsize:
+            return self.Flush()
+        return True
+
+    def Flush(self):
+        "Write all buffered results.  Returns False if the provider refused them."
+        if not self.buffer:
+            return True
+        t0 = time.perf_counter()
+        if self.journal is not None:
+            self.journal.Sync()
+        result = self.bprovider.changeAttributeValues(self.buffer)
+        self.buffer = {}
+        if self.timer is not None:
+            self.timer.Stop('write', t0)
+        return result
+
+def main(argv=None):
+    "Command line entry point for headless simulation runs"
+    from qgis.core import QgsApplication, QgsVectorLayer
+
+    parser = argparse.ArgumentParser(description='Geospatial Simulation batch controller')
+    parser.add_argument('controlfile', help='Geospatial Simulation Control (GSC) file')
+    parser.add_argument('datasource', nargs='?', help='Vector data source for the base layer')
+    parser.add_argument('--fids', help='Comma-separated feature IDs to simulate (default all)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of model processes to run at once (0 for one per CPU)')
+    parser.add_argument('--async-jobs', type=int, default=0,
+                        help='Keep this many model processes in flight from one asyncio controller')
+    parser.add_argument('--timeout', type=float,
+                        help='Kill a model run after this many seconds')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='Number of times to rerun a model that timed out')
+    parser.add_argument('--speculate', type=float, default=0.0,
+                        help='With --workers, rerun features taking this many times the median feature time on idle workers')
+    parser.add_argument('--resident',
+                        help='Command starting a long-lived model that runs one feature per RUN request')
+    parser.add_argument('--stage', nargs='?', const='/dev/shm',
+                        help='Run the model in scratch directories in this RAM-backed directory (default /dev/shm)')
+    parser.add_argument('--link', action='store_true',
+                        help='Link the model files into scratch directories instead of copying them')
+    parser.add_argument('--fifo', action='store_true',
+                        help='Pass model inputs and outputs through named pipes instead of files (POSIX only)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Render and parse other features on threads while the model runs')
+    parser.add_argument('--render-only', metavar='DIR',
+                        help='Write the model inputs of each feature to DIR/fid without running the model')
+    parser.add_argument('--ingest-only', metavar='DIR',
+                        help='Read the model outputs in DIR/fid left by running the models of --render-only')
+    parser.add_argument('--commit-size', type=int, default=1000,
+                        help='Number of feature results written to the base layer at once')
+    parser.add_argument('--dedupe', action='store_true',
+                        help='Run the model once per unique combination of input attributes')
+    parser.add_argument('--journal', action='store_true',
+                        help='Record completed features in controlfile.journal')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip features recorded in the journal and reuse their results')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only simulate features whose inputs changed since they were last simulated')
+    parser.add_argument('--cache', help='Directory of cached model results')
+    parser.add_argument('--cache-size', type=float, default=1024.0,
+                        help='Size limit of the result cache in MB')
+    parser.add_argument('--clear-cache', action='store_true',
+                        help='Delete all cached results and exit')
+    parser.add_argument('--log-dir', help='Write model output to log files in this directory')
+    parser.add_argument('--log-level', type=int, default=1, choices=[0, 1, 2],
+                        help='0 discards model output, 1 keeps rotating logs, 2 keeps one log per feature')
+    parser.add_argument('--verbose', action='store_true', help='Print a summary of each model run')
+    parser.add_argument('--timing', action='store_true',
+                        help='Print the time spent in each stage of the run')
+    parser.add_argument('--trace', help='Write stage timings to this Chrome trace_event JSON file')
+    args = parser.parse_args(argv)
+
+    cache = None
+    if args.cache:
+        cache = ResultCache.ResultCache(os.path.abspath(args.cache),
+                                        int(args.cache_size * 1024 * 1024))
+    if args.clear_cache:
+        if cache is None:
+            parser.error('--clear-cache requires --cache')
+        cache.Clear()
+        return 0
+    if args.datasource is None:
+        parser.error('the following arguments are required: datasource')
+    if args.render_only and args.ingest_only:
+        parser.error('--render-only and --ingest-only cannot be used together')
+
+    qgs = QgsApplication([], False)
+    qgs.initQgis()
+    try:
+        #Read control file relative to its own directory, as in the dialog
+        cfilename = os.path.abspath(args.controlfile)
+        datasource = args.datasource
+        path = datasource.split('|')[0] #Options such as |layername=
+        if os.path.exists(path): #Not a database connection or URL
+            datasource = os.path.abspath(path) + datasource[len(path):]
+        if args.log_dir:
+            logdir = os.path.abspath(args.log_dir)
+        if args.trace:
+            tracefile = os.path.abspath(args.trace)
+        if args.render_only:
+            deckdir = os.path.abspath(args.render_only)
+        if args.ingest_only:
+            deckdir = os.path.abspath(args.ingest_only)
+        if args.fifo and not hasattr(os, 'mkfifo'):
+            sys.stderr.write('Named pipes are not available on this system.\n')
+            return 1
+        stage = None
+        if args.stage:
+            stage = os.path.abspath(args.stage)
+            if not os.path.isdir(stage):
+                sys.stderr.write('Staging directory not found: %s\n' % stage)
+                return 1
+        cfile = ControlFile.ControlFile()
+        if cfile.ReadFile(cfilename):
+            sys.stderr.write('Error reading control file.\n')
+            return 1
+        os.chdir(os.path.dirname(cfilename))
+
+        blayer = QgsVectorLayer(datasource, cfile.BaseLayer, 'ogr')
+        if not blayer.isValid():
+            sys.stderr.write('Base layer not found: %s\n' % datasource)
+            return 1
+
+        engine = SimEngine(cfile, blayer)
+        engine.workers = args.workers or multiprocessing.cpu_count()
+        engine.commitsize = max(args.commit_size, 1)
+        engine.asyncjobs = max(args.async_jobs, 0)
+        engine.timeout = args.timeout
+        engine.retries = max(args.retries, 0)
+        engine.speculate = max(args.speculate, 0.0)
+        engine.resident = args.resident
+        engine.stage = stage
+        engine.link = args.link
+        engine.fifo = args.fifo
+        engine.pipeline = args.pipeline
+        if args.log_dir:
+            engine.modellog = ModelLog.ModelLog(logdir, verbosity=args.log_level)
+        if args.timing or args.trace:
+            engine.timer = StageTimer.StageTimer(args.trace is not None)
+        engine.cache = cache
+        engine.dedupe = args.dedupe
+        if args.journal or args.resume:
+            engine.journal = RunJournal.RunJournal(cfilename + '.journal')
+            engine.resume = args.resume
+        if args.incremental:
+            engine.fingerprints = Fingerprints.FingerprintFile(cfilename + '.fingerprints')
+            engine.incremental = True
+        if engine.CheckControlFile():
+            sys.stderr.write(engine.error + '\n')
+            return 1
+
+        featids = None
+        if args.fids:
+            featids = [int(i) for i in args.fids.split(',')]
+
+        width = [0]
+        def show(reporter, b1, b2):
+            #Pad to the longest line so far to overwrite it
+            text = reporter.Text()
+            width[0] = max(width[0], len(text))
+            sys.stderr.write('\r' + text.ljust(width[0]))
+        progress = ProgressReporter.ProgressReporter(show, timer=engine.timer)
+        progress.Start()
+        log = None
+        if args.verbose and engine.asyncjobs and engine.modellog is None:
+            engine.stream = lambda fid, name, text: sys.stdout.write(text)
+        elif args.verbose:
+            log = lambda text: sys.stdout.write(text + '\n')
+        if args.render_only:
+            ret = engine.Render(deckdir, featids, progress.Update)
+        elif args.ingest_only:
+            ret = engine.Ingest(deckdir, featids, progress.Update)
+        else:
+            ret = engine.Run(featids, progress.Update, log)
+        progress.Finish()
+        sys.stderr.write('\n')
+        if ret:
+            sys.stderr.write(engine.error + '\n')
+        if args.timing:
+            sys.stderr.write(engine.timer.Summary() + '\n')
+        if args.trace:
+            engine.timer.WriteTrace(tracefile)
+        return ret
+    finally:
+        qgs.exitQgis()
+
+if __name__ == '__main__':
+    sys.exit(main())
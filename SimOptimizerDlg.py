@@ -132,6 +132,7 @@ class SimOptimizerDlg(QDialog):
                              
         #Initializations
         b1 = 0
+        self.sim.engine.timer.Clear()
         self.ui.ProgressBar.setValue(0)
         self.setCursor(Qt.WaitCursor)
         featreq = QgsFeatureRequest()
@@ -203,6 +204,12 @@ class SimOptimizerDlg(QDialog):
             self.sim.blayer.selectByIds(self.selectedIDs)
         else:
             self.sim.blayer.removeSelection()
+
+        #Stage timings of the simulations and evaluations
+        f = open(self.logfile, 'a')
+        f.write(self.sim.engine.timer.Summary() + '\n\n')
+        f.close()
+        self.sim.WriteTiming()
                 
         self.setCursor(Qt.ArrowCursor)
     
@@ -256,9 +263,8 @@ class SimOptimizerDlg(QDialog):
         for featid in bfeatids:
             self.sim.ui.cbxOnlySelected.setChecked(1)            
             self.sim.blayer.selectByIds([featid])            
-            self.sim.on_btnRun_clicked()       
-            self.ui.textSimulation.append(self.sim.p.stdout)
-            self.ui.textSimulation.append(self.sim.p.stderr)
+            self.sim.Simulate()
+            self.ui.textSimulation.append(self.sim.summary)
            
     @pyqtSlot()
     def on_btnExit_clicked(self):
@@ -277,6 +283,8 @@ class Optimize(anneal.Anneal):
     def evaluate(self):
         
         #Write parameters to GIS
+        timer = self.sim.engine.timer
+        t0 = timer.Start()
         bfeat = QgsFeature()
         featreq = QgsFeatureRequest()
         i=0
@@ -303,16 +311,17 @@ class Optimize(anneal.Anneal):
         #Can't get attribute table repainting to work for all conditions.
         self.sim.blayer.selectByIds(self.bfeatids)
         QApplication.processEvents()
+        timer.Stop('update', t0)
         
         #Run simulations   
         for featid in self.bfeatids:
             self.sim.ui.cbxOnlySelected.setChecked(1) 
             self.sim.blayer.selectByIds([featid])          
-            self.sim.on_btnRun_clicked()       
-            self.ui.textSimulation.append(self.sim.p.stdout)
-            self.ui.textSimulation.append(self.sim.p.stderr)
+            self.sim.Simulate()
+            self.ui.textSimulation.append(self.sim.summary)
         
         #Calculate error
+        t1 = timer.Start()
         sqrerr = []
         for featid in self.bfeatids:
             bfeat = next(self.sim.blayer.getFeatures(featreq.setFilterFid(featid)))
@@ -327,6 +336,8 @@ class Optimize(anneal.Anneal):
                 
         sumsq = sum(sqrerr) / len(sqrerr)
         rmse = math.sqrt(sumsq) 
+        timer.Stop('objective', t1)
+        timer.Stop('evaluate', t0)
                     
         #Output
         string = '%4d ' % self.iterat
@@ -0,0 +1,535 @@
+"""
+/***************************************************************************
+Name                 : Geospatial Simulation
+Description          : Geospatial tool for managing point-based simulation models
+Date                 : 05/Dec/11
+copyright            : (C) 2011 by Dr. Kelly Thorp, USDA-ARS
+email                : kelly.thorp@ars.usda.gov
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Per-feature simulation work: write inputs, run the model, read outputs.
+ This module does not import Qt or QGIS so it can run in worker processes.
+"""
+from __future__ import absolute_import
+from builtins import range
+from builtins import object
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from . import ModelFifo
+from . import ModelLauncher
+from . import ModelLog
+from . import OutputFile
+from . import ResidentModel
+from . import StageTimer
+
+#Error of a feature whose model runs all timed out
+TIMEDOUT = 'Model run timed out.'
+
+class SimWorker(object):
+    """Simulate single features in a model directory
+
+    Inputs:
+    cfile    -- ControlFile for the simulation
+    templates-- {TemplateInput key : compiled TemplateFile}
+    instructions -- {InstructionOutput key : compiled InstructionFile}
+    formats  -- {AttributeCode key : TemplateFile.CodeFormat}
+    findex   -- {output attribute name : base layer field index}
+    modeldir -- Absolute path of the model directory
+    workdir  -- Directory where inputs are written and the model is run
+    cache    -- Optional ResultCache for parsed outputs
+    modellog -- Optional ModelLog for model output.  Without one, output is
+                captured in memory and only a summary is kept.
+    timer    -- Optional StageTimer for the render, model and parse stages
+
+    Set timeout to limit each model run to that many seconds and retries to
+    rerun a model that timed out.  Set resident to a ResidentModel to run
+    features in a long-lived model process instead of the command line.  Set
+    fifo to pass inputs and outputs through named pipes instead of files."""
+
+    def __init__(self, cfile, templates, instructions, formats, findex, modeldir, workdir,
+                 cache=None, modellog=None, timer=None):
+        self.cfile = cfile
+        self.templates = templates
+        self.instructions = instructions
+        self.formats = formats
+        self.findex = findex
+        self.modeldir = modeldir
+        self.workdir = workdir
+        self.cache = cache
+        self.modellog = modellog
+        self.timer = timer
+        self.tid = None
+        self.timeout = None
+        self.retries = 0
+        self.resident = None
+        self.fifo = False
+        self.texts = None
+        self.fifodata = None
+        self.command = ModelLauncher.ModelCommand(cfile.CommandLine, modeldir)
+        self.error = ''
+        self.p = None
+        self.summary = None
+        self.ckey = None
+
+        #Everything besides the rendered inputs that decides the parsed outputs
+        self.salt = [cfile.CommandLine]
+        for key in sorted(cfile.TemplateInput.keys()):
+            self.salt.append(cfile.TemplateInput[key][1])
+        for key in sorted(cfile.InstructionOutput.keys()):
+            self.salt.append(cfile.InstructionOutput[key][1])
+            self.salt.append(repr(instructions[key].program))
+
+    def Path(self, name):
+        "Locate a control file path in the working directory"
+        if os.path.isabs(name):
+            rel = os.path.relpath(name, self.modeldir)
+            if rel.startswith(os.pardir):
+                return name
+            name = rel
+        return os.path.join(self.workdir, name)
+
+    def Simulate(self, fid, values):
+        """Simulate feature fid.  values is {AttributeCode key : attribute value}.
+        Returns {field index : value}, None on error."""
+        attr = self.Begin(values)
+        if attr is not None:
+            return attr
+        t0 = time.perf_counter()
+        self.RunModel(fid)
+        self.Time('model', t0)
+        if self.p.returncode is None:
+            self.error = TIMEDOUT
+            return None
+        return self.End()
+
+    def Begin(self, values):
+        """Write the model inputs for one feature.  Returns the cached
+        {field index : value} if the result cache has this run, otherwise None
+        and the model must be run before calling End."""
+        t0 = time.perf_counter()
+        self.error = ''
+        self.p = None
+        self.summary = None
+        self.ckey = None
+        texts = self.RenderInputs(values)
+        if self.cache is not None:
+            self.ckey = self.cache.Key(self.salt + [texts[key] for key in sorted(texts.keys())])
+            outputs = self.cache.Get(self.ckey)
+            if outputs is not None:
+                self.Time('render', t0)
+                return self.Attributes(outputs)
+        if self.fifo:
+            self.texts = texts #Written to the pipes while the model runs
+        else:
+            self.WriteInputs(texts)
+        self.Time('render', t0)
+        return None
+
+    def End(self):
+        """Read the outputs of the model run started by Begin, {field index : value}.
+        Returns None if an output file is missing."""
+        t0 = time.perf_counter()
+        outputs = self.ReadOutputs()
+        if outputs is None:
+            return None
+        if self.ckey is not None and self.p.returncode == 0:
+            self.cache.Put(self.ckey, outputs)
+        attr = self.Attributes(outputs)
+        self.Time('parse', t0)
+        return attr
+
+    def Time(self, stage, start):
+        "Record a stage that began at perf_counter() start"
+        if self.timer is not None:
+            self.timer.Stop(stage, start, self.tid)
+
+    def SimulateBatch(self, tasks, batch):
+        """Simulate several features in one model run.  tasks is [(fid, values)]
+        and batch the settings from BatchSettings.  Returns a
+        {field index : value} for each task, None on error."""
+        t0 = time.perf_counter()
+        self.error = ''
+        self.p = None
+        self.summary = None
+        self.WriteBatchInputs([values for fid, values in tasks], batch)
+        self.Time('render', t0)
+        t0 = time.perf_counter()
+        self.RunModel('%s-%s' % (tasks[0][0], tasks[-1][0]))
+        self.Time('model', t0)
+        if self.p.returncode is None:
+            self.error = TIMEDOUT
+            return None
+        t0 = time.perf_counter()
+        outputs = self.ReadBatchOutputs(len(tasks), batch)
+        if outputs is None:
+            return None
+        attrs = [self.Attributes(output) for output in outputs]
+        self.Time('parse', t0)
+        return attrs
+
+    def WriteBatchInputs(self, valuelist, batch):
+        """Write the inputs of several features, as repeated blocks of one input
+        file in block mode, or as numbered input files listed in BatchFile in
+        files mode"""
+        sites = [self.RenderInputs(values) for values in valuelist]
+        keys = sorted(self.cfile.TemplateInput.keys())
+        if batch['Mode'] == 'block':
+            self.WriteInputs(dict([(key, ''.join([texts[key] for texts in sites]))
+                                   for key in keys]))
+            return
+        listing = []
+        for i, texts in enumerate(sites):
+            names = [SiteName(self.cfile.TemplateInput[key][1], i + 1) for key in keys]
+            for key, name in zip(keys, names):
+                f = open(self.Path(name), 'w')
+                f.write(texts[key])
+                f.close()
+            listing.append(' '.join(names) + '\n')
+        f = open(self.Path(batch['BatchFile']), 'w')
+        f.write(''.join(listing))
+        f.close()
+
+    def ReadBatchOutputs(self, count, batch):
+        """Split each output file into count site sections, each starting on a
+        line containing the Split token, and run the instructions on each
+        section.  Returns [[(attribute, value)]] per site, None on error."""
+        outputs = [[] for i in range(count)]
+        for key in list(self.cfile.InstructionOutput.keys()):
+            path = self.Path(self.cfile.InstructionOutput[key][1])
+            try:
+                output = OutputFile.OutputFile(path)
+            except (IOError, OSError):
+                self.error = 'Output file not found: %s' % self.cfile.InstructionOutput[key][1]
+                return None
+            try:
+                data = output.data
+                token = batch['Split'].encode(output.encoding)
+                starts = []
+                pos = data.find(token)
+                while pos >= 0:
+                    starts.append(data.rfind(b'\n', 0, pos) + 1)
+                    end = data.find(b'\n', pos)
+                    if end < 0:
+                        break
+                    pos = data.find(token, end + 1)
+                if len(starts) != count:
+                    self.error = ('Output file %s has %d site sections for %d features.' %
+                                  (self.cfile.InstructionOutput[key][1], len(starts), count))
+                    return None
+                starts.append(output.size)
+                for i in range(count):
+                    section = OutputFile.OutputFile(output.path, output.encoding,
+                                                    data[starts[i]:starts[i+1]])
+                    outputs[i].extend(self.instructions[key].Execute(section))
+            finally:
+                output.Close()
+        return outputs
+
+    def RenderInputs(self, values):
+        "Render the model input files for one feature, {TemplateInput key : text}"
+        svalues = {}
+        for key in list(self.formats.keys()):
+            svalues.update({key:self.formats[key].Format(values[key])})
+        texts = {}
+        for key in list(self.cfile.TemplateInput.keys()):
+            texts.update({key:self.templates[key].Render(svalues)})
+        return texts
+
+    def WriteInputs(self, texts):
+        "Write rendered model input files"
+        for key in list(texts.keys()):
+            f = open(self.Path(self.cfile.TemplateInput[key][1]), 'w')
+            f.write(texts[key])
+            f.close()
+
+    def RunModel(self, fid=None):
+        """Run the model command line in the working directory.  If every
+        attempt times out, self.p.returncode is None."""
+        for attempt in range(self.retries + 1):
+            target = self.OpenLog(fid)
+            fifo = self.StartFifo()
+            try:
+                if self.resident is not None:
+                    self.p = self.resident.Run(self.workdir, target, self.timeout)
+                else:
+                    self.p = ModelLauncher.Run(self.command, target,
+                                               self.StderrTarget(target), self.workdir,
+                                               self.timeout, self.timer, self.tid)
+            except subprocess.TimeoutExpired as e:
+                self.p = subprocess.CompletedProcess(e.cmd, None, e.output, e.stderr)
+            finally:
+                self.EndFifo(fifo)
+            self.CloseLog(target, fid)
+            if self.p.returncode is not None:
+                break
+
+    def StartFifo(self):
+        "In fifo mode, set up the pipes for a model run about to start"
+        if not self.fifo:
+            return None
+        inputs = {}
+        for key in list(self.texts.keys()):
+            inputs.update({self.Path(self.cfile.TemplateInput[key][1]):self.texts[key]})
+        outputs = [self.Path(self.cfile.InstructionOutput[key][1])
+                   for key in self.cfile.InstructionOutput]
+        fifo = ModelFifo.ModelFifo(inputs, outputs)
+        fifo.Start()
+        return fifo
+
+    def EndFifo(self, fifo):
+        "Collect the outputs from the pipes of StartFifo after the model exits"
+        if fifo is not None:
+            self.fifodata = fifo.Finish()
+
+    def OpenLog(self, fid):
+        "Return the stdout target for a model run"
+        if self.modellog is None:
+            return subprocess.PIPE
+        return self.modellog.Open(fid)
+
+    def StderrTarget(self, target):
+        if target == subprocess.PIPE:
+            return subprocess.PIPE
+        return subprocess.STDOUT
+
+    def CloseLog(self, target, fid):
+        "Close the target from OpenLog and set the run summary"
+        if target == subprocess.PIPE:
+            self.summary = ModelLog.Summary(fid, self.p.returncode, self.p.stdout, self.p.stderr)
+            self.p.stdout = None
+            self.p.stderr = None
+        else:
+            self.summary = self.modellog.Close(target, fid, self.p.returncode)
+
+    def ReadOutputs(self):
+        "Read model output files and return [(attribute, value)], None on error"
+        outputs = []
+        for key in list(self.cfile.InstructionOutput.keys()):
+            path = self.Path(self.cfile.InstructionOutput[key][1])
+            if self.fifo:
+                if path not in self.fifodata: #The model did not write it
+                    self.error = 'Output file not found: %s' % self.cfile.InstructionOutput[key][1]
+                    return None
+                output = OutputFile.OutputFile(path, data=self.fifodata[path])
+            else:
+                try:
+                    output = OutputFile.OutputFile(path)
+                except (IOError, OSError):
+                    self.error = 'Output file not found: %s' % self.cfile.InstructionOutput[key][1]
+                    return None
+            try:
+                outputs.extend(self.instructions[key].Execute(output))
+            finally:
+                output.Close()
+        return outputs
+
+    def Attributes(self, outputs):
+        "Convert [(attribute, value)] to {field index : value}"
+        attr = {}
+        for attribute, value in outputs:
+            attr.update({self.findex.get(attribute, -1):value})
+        return attr
+
+    def DeckPath(self, fid, name):
+        "Locate a control file path in the directory of feature fid under workdir"
+        if os.path.isabs(name):
+            name = os.path.relpath(name, self.modeldir)
+        return os.path.join(self.workdir, str(fid), name)
+
+    def RenderDeck(self, fid, values):
+        "Write the model inputs of feature fid in its directory under workdir"
+        t0 = time.perf_counter()
+        texts = self.RenderInputs(values)
+        for key in list(texts.keys()):
+            path = self.DeckPath(fid, self.cfile.TemplateInput[key][1])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            f = open(path, 'w')
+            f.write(texts[key])
+            f.close()
+        self.Time('render', t0)
+
+    def IngestDeck(self, fid):
+        """Read the model outputs of feature fid from its directory under
+        workdir.  Returns {field index : value}, None if an output is missing."""
+        t0 = time.perf_counter()
+        self.error = ''
+        outputs = []
+        for key in list(self.cfile.InstructionOutput.keys()):
+            path = self.DeckPath(fid, self.cfile.InstructionOutput[key][1])
+            try:
+                output = OutputFile.OutputFile(path)
+            except (IOError, OSError):
+                self.error = 'Output file not found: %s' % path
+                return None
+            try:
+                outputs.extend(self.instructions[key].Execute(output))
+            finally:
+                output.Close()
+        attr = self.Attributes(outputs)
+        self.Time('parse', t0)
+        return attr
+
+def MakeScratch(modeldir, root, written=None):
+    """Copy the model directory into a new scratch directory under root.  If
+    written is given, files are symbolic links to the model directory instead,
+    except the paths in written, which each run writes itself."""
+    scratch = os.path.join(tempfile.mkdtemp(dir=root), 'model')
+    if written is None:
+        shutil.copytree(modeldir, scratch)
+        return scratch
+    for dirpath, dirnames, filenames in os.walk(modeldir):
+        rel = os.path.relpath(dirpath, modeldir)
+        os.makedirs(os.path.join(scratch, rel), exist_ok=True)
+        for name in filenames:
+            relname = os.path.normpath(os.path.join(rel, name))
+            if relname in written:
+                continue
+            try:
+                os.symlink(os.path.join(dirpath, name), os.path.join(scratch, relname))
+            except OSError: #No symbolic links on this system
+                shutil.copy2(os.path.join(dirpath, name), os.path.join(scratch, relname))
+    return scratch
+
+def SiteName(name, site):
+    "Input file name of one site in files batch mode: name_site.ext"
+    root, ext = os.path.splitext(name)
+    return '%s_%d%s' % (root, site, ext)
+
+def BatchSettings(cfile):
+    """Check the batch settings of the control file (*GSC8).  Returns
+    (settings, error message); settings is None if batch mode is off."""
+    if not cfile.Batch:
+        return None, ''
+    batch = {'BatchSize':'1', 'Mode':'block', 'Split':'', 'BatchFile':''}
+    for key in cfile.Batch:
+        if key not in batch:
+            return None, 'Unknown batch setting in control file: %s' % key
+        batch.update({key:cfile.Batch[key]})
+    try:
+        batch.update({'BatchSize':int(batch['BatchSize'])})
+    except ValueError:
+        return None, 'Batch size in control file is not a number.'
+    if batch['BatchSize'] < 1:
+        return None, 'Batch size in control file must be at least 1.'
+    batch.update({'Mode':batch['Mode'].strip().lower()})
+    if batch['Mode'] not in ['block', 'files']:
+        return None, 'Batch mode in control file must be block or files.'
+    if not batch['Split']:
+        return None, 'Control file batch settings need a Split token.'
+    if batch['Mode'] == 'files' and not batch['BatchFile'].strip():
+        return None, 'Control file batch settings need a BatchFile in files mode.'
+    batch.update({'BatchFile':batch['BatchFile'].strip()})
+    return batch, ''
+
+def WrittenFiles(cfile, modeldir):
+    "Paths in the model directory of the input and output files, relative to it"
+    written = set()
+    names = [cfile.TemplateInput[key][1] for key in cfile.TemplateInput]
+    names.extend([cfile.InstructionOutput[key][1] for key in cfile.InstructionOutput])
+    batch, error = BatchSettings(cfile)
+    if batch is not None and batch['Mode'] == 'files':
+        names.append(batch['BatchFile'])
+        for key in cfile.TemplateInput:
+            for site in range(1, batch['BatchSize'] + 1):
+                names.append(SiteName(cfile.TemplateInput[key][1], site))
+    for name in names:
+        rel = os.path.normpath(os.path.relpath(os.path.join(modeldir, name), modeldir))
+        if not rel.startswith(os.pardir):
+            written.add(rel)
+    return written
+
+#Worker process state, set by InitProcess
+worker = None
+
+def InitProcess(cfile, templates, instructions, formats, findex, modeldir, root, cache, modellog,
+                timing=False, timeout=None, retries=0, resident=None, written=None,
+                fifo=False, trace=False):
+    "Process pool initializer: give each worker its own copy of the model"
+    global worker
+    ModelLauncher.piddir = PidDirectory(root)
+    scratch = MakeScratch(modeldir, root, written)
+    if modellog is not None:
+        modellog = modellog.Copy(os.getpid())
+    timer = None
+    if timing:
+        timer = StageTimer.StageTimer(trace)
+    worker = SimWorker(cfile, templates, instructions, formats, findex, modeldir, scratch,
+                       cache, modellog, timer)
+    worker.timeout = timeout
+    worker.retries = retries
+    worker.fifo = fifo
+    if resident:
+        worker.resident = ResidentModel.ResidentModel(resident, scratch)
+
+def PidDirectory(root):
+    "Directory under the scratch root where pool workers record running models"
+    return os.path.join(root, 'models')
+
+def BatchResults(tasks, attrs, summary, error):
+    """Per feature (fid, attr, summary, error) of a SimulateBatch run.  The
+    summary of the model run goes with the first feature."""
+    results = []
+    for i, (fid, values) in enumerate(tasks):
+        results.append((fid, attrs[i] if attrs is not None else None,
+                        summary if i == 0 else None, error))
+    return results
+
+def SimulateBatchProcess(args):
+    """Process pool task: simulate a batch of (fid, values) and return
+    ([(fid, attr, summary, error)], timer stages)"""
+    tasks, batch = args
+    attrs = worker.SimulateBatch(tasks, batch)
+    events = None
+    if worker.timer is not None:
+        events = worker.timer.Take()
+    return BatchResults(tasks, attrs, worker.summary, worker.error), events
+
+def SimulateProcess(task):
+    """Process pool task: simulate (fid, values) and return
+    (fid, attr, summary, error, timer stages, elapsed seconds)"""
+    t0 = time.perf_counter()
+    fid, values = task
+    attr = worker.Simulate(fid, values)
+    events = None
+    if worker.timer is not None:
+        events = worker.timer.Take()
+    return (fid, attr, worker.summary, worker.error, events, time.perf_counter() - t0)
+
+def InitDeckProcess(cfile, templates, instructions, formats, findex, modeldir, decks,
+                    timing=False, trace=False):
+    """Process pool initializer for render-only and ingest-only runs, with the
+    feature directories under decks"""
+    global worker
+    timer = None
+    if timing:
+        timer = StageTimer.StageTimer(trace)
+    worker = SimWorker(cfile, templates, instructions, formats, findex, modeldir, decks,
+                       timer=timer)
+
+def RenderDeckProcess(task):
+    "Process pool task: render the inputs of (fid, values), return (fid, timer stages)"
+    fid, values = task
+    worker.RenderDeck(fid, values)
+    events = None
+    if worker.timer is not None:
+        events = worker.timer.Take()
+    return (fid, events)
+
+def IngestDeckProcess(fid):
+    "Process pool task: read the outputs of fid, return (fid, attr, error, timer stages)"
+    attr = worker.IngestDeck(fid)
+    events = None
+    if worker.timer is not None:
+        events = worker.timer.Take()
+    return (fid, attr, worker.error, events)
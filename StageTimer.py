@@ -0,0 +1,189 @@
+"""
+/***************************************************************************
+Name                 : Geospatial Simulation
+Description          : Geospatial tool for managing point-based simulation models
+Date                 : 05/Dec/11
+copyright            : (C) 2011 by Dr. Kelly Thorp, USDA-ARS
+email                : kelly.thorp@ars.usda.gov
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Stage timing of simulation runs.  This module does not import Qt or QGIS.
+"""
+from builtins import range
+from builtins import object
+import json
+import math
+import os
+import threading
+import time
+
+#Histogram bucket upper bounds in milliseconds
+BUCKETS = [0.1, 1.0, 10.0, 100.0, 1000.0, 10000.0]
+#Fine buckets per factor of ten, counted from 1 microsecond, for percentiles
+FINE = 20
+
+class StageTimer(object):
+    """Record how long each stage of a simulation run takes.
+
+    Call Start() before a stage and Stop(stage, start) after it.  Stages
+    recorded in other processes are merged with Take() and Add().  Only the
+    count, total, maximum and a log-scale histogram of each stage are kept,
+    so memory use does not grow with the run.  Summary() returns a text table
+    with histograms.  With trace set, each event is kept as well and
+    WriteTrace() writes a Chrome trace_event file for chrome://tracing or
+    ui.perfetto.dev.
+
+    Inputs:
+    trace     -- True to keep the events for WriteTrace()
+    maxevents -- Number of events kept for the trace.  Later events are
+                 still counted in the summary."""
+
+    def __init__(self, trace=False, maxevents=1000000):
+        self.trace = trace
+        self.maxevents = maxevents
+        self.origin = time.time() - time.perf_counter()
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.Clear()
+
+    def Clear(self):
+        self.stats = {} #{stage : [count, total seconds, max seconds, {fine bucket : count}]}
+        self.events = [] #(stage, start time, duration, pid, tid)
+        self.dropped = 0
+
+    def Start(self):
+        return time.perf_counter()
+
+    def Stop(self, stage, start, tid=None):
+        "Record stage as running from start until now"
+        duration = time.perf_counter() - start
+        if tid is None:
+            tid = threading.get_ident()
+        bucket = Bucket(duration)
+        with self.lock:
+            stats = self.stats.get(stage)
+            if stats is None:
+                stats = [0, 0.0, 0.0, {}]
+                self.stats.update({stage:stats})
+            stats[0]+=1
+            stats[1]+=duration
+            stats[2] = max(stats[2], duration)
+            stats[3].update({bucket:stats[3].get(bucket, 0) + 1})
+            if self.trace:
+                self.KeepEvents([(stage, self.origin + start, duration, self.pid, tid)])
+
+    def KeepEvents(self, events):
+        "Keep events for the trace up to maxevents, called with the lock held"
+        room = max(self.maxevents - len(self.events), 0)
+        self.events.extend(events[:room])
+        self.dropped+=max(len(events) - room, 0)
+
+    def Add(self, taken):
+        "Merge the result of Take() of another StageTimer"
+        stats, events, dropped = taken
+        with self.lock:
+            for stage in stats:
+                count, total, longest, buckets = stats[stage]
+                mine = self.stats.get(stage)
+                if mine is None:
+                    mine = [0, 0.0, 0.0, {}]
+                    self.stats.update({stage:mine})
+                mine[0]+=count
+                mine[1]+=total
+                mine[2] = max(mine[2], longest)
+                for bucket in buckets:
+                    mine[3].update({bucket:mine[3].get(bucket, 0) + buckets[bucket]})
+            if self.trace:
+                self.KeepEvents(events)
+                self.dropped+=dropped
+
+    def Take(self):
+        "Return and forget the stages recorded so far, for Add()"
+        with self.lock:
+            taken = (self.stats, self.events, self.dropped)
+            self.Clear()
+        return taken
+
+    def Totals(self):
+        "Return {stage : total seconds} of the stages recorded so far"
+        with self.lock:
+            return dict([(stage, self.stats[stage][1]) for stage in self.stats])
+
+    def Summary(self):
+        """Return a text table of the stage timings with a histogram for each
+        stage.  Percentiles are estimated from the fine buckets, to within 6%."""
+        with self.lock:
+            stats = dict([(stage, list(self.stats[stage])) for stage in self.stats])
+            dropped = self.dropped
+        if not stats:
+            return 'No stages timed.'
+        lines = ['%-10s %8s %10s %10s %10s %10s %10s' %
+                 ('Stage', 'Count', 'Total(s)', 'Mean(ms)', 'P50(ms)', 'P95(ms)', 'Max(ms)')]
+        for stage in sorted(stats.keys()):
+            count, total, longest, buckets = stats[stage]
+            lines.append('%-10s %8d %10.3f %10.3f %10.3f %10.3f %10.3f' %
+                         (stage, count, total, 1000.0 * total / count,
+                          1000.0 * Percentile(buckets, count, longest, 0.50),
+                          1000.0 * Percentile(buckets, count, longest, 0.95),
+                          1000.0 * longest))
+        for stage in sorted(stats.keys()):
+            buckets = stats[stage][3]
+            counts = [0] * (len(BUCKETS) + 1)
+            for bucket in buckets:
+                #BUCKETS are powers of ten, so each fine bucket falls in one of them
+                low = 1e-3 * 10.0 ** (float(bucket) / FINE)
+                i = 0
+                while i < len(BUCKETS) and low >= BUCKETS[i] * (1.0 - 1e-9):
+                    i+=1
+                counts[i]+=buckets[bucket]
+            lines.append('')
+            lines.append('%s (ms)' % stage)
+            for i in range(len(counts)):
+                if i < len(BUCKETS):
+                    label = '< %g' % BUCKETS[i]
+                else:
+                    label = '>= %g' % BUCKETS[-1]
+                bar = '#' * int(round(40.0 * counts[i] / max(counts)))
+                lines.append(('  %-10s %8d %s' % (label, counts[i], bar)).rstrip())
+        if dropped:
+            lines.append('')
+            lines.append('%d events not kept for the trace.' % dropped)
+        return '\n'.join(lines)
+
+    def WriteTrace(self, path):
+        "Write the events kept with trace set as a Chrome trace_event JSON file"
+        first = min([event[1] for event in self.events] or [0.0])
+        trace = []
+        for stage, start, duration, pid, tid in self.events:
+            trace.append({'name':stage, 'cat':'geosim', 'ph':'X',
+                          'ts':round(1e6 * (start - first), 3),
+                          'dur':round(1e6 * duration, 3),
+                          'pid':pid, 'tid':tid})
+        f = open(path, 'w')
+        json.dump({'traceEvents':trace, 'displayTimeUnit':'ms'}, f)
+        f.close()
+
+def Bucket(seconds):
+    "Fine bucket of a duration: FINE buckets per factor of ten from 1 microsecond"
+    if seconds <= 1e-6:
+        return 0
+    return int(math.floor(FINE * math.log10(seconds * 1e6)))
+
+def Percentile(buckets, count, longest, q):
+    "Estimate the q quantile in seconds from {fine bucket : count}"
+    rank = int(q * (count - 1))
+    seen = 0
+    for bucket in sorted(buckets.keys()):
+        seen+=buckets[bucket]
+        if seen > rank:
+            #Geometric middle of the bucket
+            return min(1e-6 * 10.0 ** ((bucket + 0.5) / FINE), longest)
+    return longest
@@ -0,0 +1,131 @@
+"""
+/***************************************************************************
+Name                 : Geospatial Simulation
+Description          : Geospatial tool for managing point-based simulation models
+Date                 : 05/Dec/11
+copyright            : (C) 2011 by Dr. Kelly Thorp, USDA-ARS
+email                : kelly.thorp@ars.usda.gov
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from builtins import str
+from builtins import range
+from builtins import object
+import os
+
+class TemplateFile(object):
+    """Read a Geospatial Simulation Template (GST) file and compile it into a
+    splice plan: literal text segments with slots where attribute codes go.
+
+    Codes are located in AttributeCode order, as the old line-by-line
+    str.replace loop did.  Substituted values are not searched again for
+    later codes."""
+
+    def __init__(self):
+        self.text = ''
+        self.plan = []
+        self.slots = []
+
+    def ReadFile(self, tfile):
+        #Check if file exists.  If so, read it.
+        if (os.path.exists(tfile)) == False:
+            return 1
+        else:
+            f = open(tfile, 'r')
+            lines = f.readlines()
+            f.close()
+
+        #Check file type
+        if not lines or lines[0][0:41] != 'Geospatial Simulation Template (GST) File':
+            return 2
+
+        self.text = ''.join(lines[1:])
+        self.plan = [self.text]
+        self.slots = []
+        return 0
+
+    def Compile(self, codes):
+        """Split the template text at each code.  codes is {key : code} and
+        rendered values are later supplied with the same keys."""
+        parts = [self.text]
+        for key in list(codes.keys()):
+            code = codes[key]
+            if not code:
+                continue
+            newparts = []
+            for part in parts:
+                if isinstance(part, str) and code in part:
+                    for i,piece in enumerate(part.split(code)):
+                        if i:
+                            newparts.append(key)
+                        newparts.append(piece)
+                else:
+                    newparts.append(part)
+            parts = newparts
+
+        #Slots hold the key as a placeholder until Render fills them
+        self.plan = []
+        self.slots = []
+        for part in parts:
+            if isinstance(part, str):
+                if part:
+                    self.plan.append(part)
+            else:
+                self.slots.append((len(self.plan), part))
+                self.plan.append('')
+
+    def Render(self, svalues):
+        "Return the template text with {key : formatted value} spliced in"
+        out = list(self.plan)
+        for i,key in self.slots:
+            out[i] = svalues[key]
+        return ''.join(out)
+
+class CodeFormat(object):
+    """Format base layer attribute values for one attribute code
+
+    Inputs:
+    index    -- Field index of the attribute in the base layer
+    ftype    -- Field type name (String, Integer, Integer64, Real or Double)
+    width    -- Width of the code in the template"""
+
+    def __init__(self, index, ftype, width):
+        self.index = index
+        self.ftype = ftype
+        self.width = width
+        if ftype in ['String']:
+            self.kind = 0
+        elif ftype in ['Integer','Integer64']:
+            self.kind = 1
+            self.fmt = '%' + str(width) + 'd'
+        elif ftype in ['Real','Double']:
+            self.kind = 2
+            #Formats for every decimal count that fits in the code width
+            self.fmts = ['%' + str(width) + '.' + str(i) + 'f' for i in range(width)]
+        else:
+            raise ValueError('ftype not found:' + str(ftype))
+
+    def Format(self, value):
+        if self.kind == 0:
+            return value.rjust(self.width)
+        elif self.kind == 1:
+            return self.fmt % int(value)
+        #Real values use all decimal places left over after the integer part
+        value = float(value)
+        if value >= 0:
+            decnum = self.width - len(str(int(value))) - 1
+        else:
+            decnum = self.width - len(str(int(value))) - 2
+        if decnum < 0:
+            myfmt = '%' + str(self.width) + '.' + str(decnum) + 'f'
+        else:
+            myfmt = self.fmts[decnum]
+        return myfmt % round(value,decnum)